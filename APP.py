@@ -1,13 +1,38 @@
+import os
+import threading
+import time
 import uuid
 import streamlit as st
 import streamlit.components.v1 as components
-from RAG_backend import (
-    ingest_pdf,
-    chatbot,
-    thread_has_document,
-    thread_document_metadata,
-)
-from langchain_core.messages import HumanMessage
+from metrics import observe, snapshot as metrics_snapshot
+from ui_render import StreamRenderer, ai_bubble, history_html, user_bubble
+
+
+# ─── Backend ────────────────────────────────────────────────────────────────
+def backend():
+    # RAG_backend (LangChain, LangGraph, FAISS) is imported on first use, so a
+    # cold server paints the page before loading it; see _start_prewarm
+    import RAG_backend
+    return RAG_backend
+
+
+if os.getenv("STARTUP_MODE", "lazy") == "eager":
+    backend()  # load everything before the first paint, as before
+
+
+@st.cache_resource(show_spinner=False)
+def _start_prewarm():
+    # Once per server process, after the first page has been sent: import the
+    # backend and build the model clients and graph before the first question
+    def _run():
+        started = time.perf_counter()
+        backend().prewarm()
+        observe("ui.prewarm", time.perf_counter() - started)
+
+    thread = threading.Thread(target=_run, name="backend-prewarm", daemon=True)
+    thread.start()
+    return thread
+
 
 # ─── Page Config ────────────────────────────────────────────────────────────
 st.set_page_config(
@@ -206,15 +231,26 @@ hr { border-color: rgba(255,255,255,0.05) !important; }
 """, unsafe_allow_html=True)
 
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def _history_html(turns: tuple) -> str:
+    # One element for the whole history: it is identical across reruns, so
+    # Streamlit's message cache sends the browser a hash instead of the HTML
+    return history_html(turns)
+
+
 # ─── State ──────────────────────────────────────────────────────────────────
 if "thread_id"    not in st.session_state: st.session_state.thread_id    = str(uuid.uuid4())
 if "chat_history" not in st.session_state: st.session_state.chat_history = []
 if "pdf_ready"    not in st.session_state: st.session_state.pdf_ready    = False
 if "pdf_meta"     not in st.session_state: st.session_state.pdf_meta     = {}
 if "stop_stream"  not in st.session_state: st.session_state.stop_stream  = False
+if "seen_jobs"    not in st.session_state: st.session_state.seen_jobs    = set()
+if "has_jobs"     not in st.session_state: st.session_state.has_jobs     = False
 
 thread_id = st.session_state.thread_id
 config    = {"configurable": {"thread_id": thread_id}}
+# Stage timings in the sidebar: DEBUG_PANEL=1 or ?debug=1
+debug_panel = os.getenv("DEBUG_PANEL") == "1" or st.query_params.get("debug") == "1"
 
 
 # ─── Sidebar ─────────────────────────────────────────────────────────────────
@@ -225,31 +261,77 @@ with st.sidebar:
     uploaded_file = st.file_uploader("PDF", type="pdf", label_visibility="collapsed")
     if uploaded_file:
         st.markdown(f'<div class="pill-violet">📎 {uploaded_file.name}</div>', unsafe_allow_html=True)
-        if st.button("⚡ Build Knowledge Base"):
-            with st.spinner("Indexing..."):
-                try:
-                    meta = ingest_pdf(
-                        file_bytes=uploaded_file.read(),
-                        thread_id=thread_id,
-                        filename=uploaded_file.name,
-                    )
-                    st.session_state.pdf_ready    = True
-                    st.session_state.pdf_meta     = meta
-                    st.session_state.chat_history = []
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Indexing failed: {e}")
+        build_label = "➕ Add to Knowledge Base" if st.session_state.pdf_ready else "⚡ Build Knowledge Base"
+        if st.button(build_label):
+            # Ingestion runs on the backend's worker pool; the fragment below polls it
+            try:
+                backend().submit_ingest_job(uploaded_file.getvalue(), thread_id, uploaded_file.name)
+                st.session_state.has_jobs = True
+                st.rerun()
+            except Exception as e:
+                st.error(f"Indexing failed: {e}")
+
+    def ingest_jobs_panel():
+        rb = backend()
+        jobs = rb.thread_ingest_jobs(thread_id)
+        finished = False
+        for job in jobs:
+            if job["state"] in rb.JOB_ACTIVE_STATES:
+                eta = job["eta_seconds"]
+                text = (
+                    f'⏳ {job["filename"]} · queued' if job["state"] == "queued" else
+                    f'📑 {job["pages_parsed"]}/{job["pages_total"]} pages · '
+                    f'🧩 {job["chunks_embedded"]}/{job["chunks_total"]} chunks'
+                    + (f" · ~{eta:.0f}s left" if eta is not None else "")
+                )
+                bar_col, cancel_col = st.columns([5, 1])
+                with bar_col:
+                    st.progress(job["progress"], text=text)
+                with cancel_col:
+                    if st.button("✕", key=f"cancel_{job['job_id']}", help="Cancel indexing"):
+                        rb.cancel_ingest_job(job["job_id"])
+            elif job["job_id"] not in st.session_state.seen_jobs:
+                st.session_state.seen_jobs.add(job["job_id"])
+                finished = True
+                if job["state"] == "done":
+                    if not st.session_state.pdf_ready:
+                        st.session_state.chat_history = []
+                    st.session_state.pdf_ready = True
+                    st.session_state.pdf_meta  = rb.thread_document_metadata(thread_id)
+                elif job["state"] == "failed":
+                    st.session_state.ingest_error = f'{job["filename"]}: {job["error"]}'
+        if finished:
+            st.rerun()  # whole app: the chat area depends on pdf_ready
+
+    # A session that never submitted a job has none to poll (and needn't load the backend)
+    if st.session_state.has_jobs:
+        rb = backend()
+        if any(job["state"] in rb.JOB_ACTIVE_STATES for job in rb.thread_ingest_jobs(thread_id)):
+            st.fragment(run_every=1.0)(ingest_jobs_panel)()
+        else:
+            ingest_jobs_panel()  # picks up jobs that ended since the last poll
+    if "ingest_error" in st.session_state:
+        st.error(f"Indexing failed: {st.session_state.pop('ingest_error')}")
 
     if st.session_state.pdf_ready:
         meta = st.session_state.pdf_meta
         st.markdown('<div class="s-section">Status</div>', unsafe_allow_html=True)
         st.markdown('<div class="pill-green">&#x2714; Active</div>', unsafe_allow_html=True)
-        st.markdown(
-            f'<div class="s-meta">📄 {meta.get("filename","?")}<br>'
-            f'📑 {meta.get("documents","?")} pages &nbsp;&#183;&nbsp; '
-            f'🧩 {meta.get("chunks","?")} chunks</div>',
-            unsafe_allow_html=True
-        )
+        for f in meta.get("files", []):
+            file_col, rm_col = st.columns([5, 1])
+            with file_col:
+                st.markdown(
+                    f'<div class="s-meta">📄 {f["filename"]}<br>'
+                    f'📑 {f["pages"]} pages &nbsp;&#183;&nbsp; '
+                    f'🧩 {f["chunks"]} chunks</div>',
+                    unsafe_allow_html=True
+                )
+            with rm_col:
+                if st.button("✕", key=f"rm_{f['doc_id']}", help="Remove this document"):
+                    backend().remove_document(thread_id, f["doc_id"])
+                    st.session_state.pdf_meta  = backend().thread_document_metadata(thread_id)
+                    st.session_state.pdf_ready = bool(st.session_state.pdf_meta)
+                    st.rerun()
         st.markdown("<hr>", unsafe_allow_html=True)
         if st.button("🗑️ Clear Chat"):
             st.session_state.chat_history = []
@@ -263,6 +345,14 @@ with st.sidebar:
         <b>Agent</b>&nbsp; LangGraph
     </div>""", unsafe_allow_html=True)
 
+    if debug_panel:
+        with st.expander("⏱️ Stage timings"):
+            rows = metrics_snapshot()
+            if rows:
+                st.dataframe(rows, hide_index=True, use_container_width=True)
+            else:
+                st.caption("No timings recorded yet.")
+
 
 # ─── Main area ───────────────────────────────────────────────────────────────
 ready   = st.session_state.pdf_ready
@@ -306,31 +396,23 @@ with chat_box:
             <div class="empty-sub rdy">I have read and indexed your document.<br>What would you like to know?</div>
         </div>""", unsafe_allow_html=True)
     else:
-        # Render all committed history
-        for turn in history:
-            q      = turn["question"]
-            a      = turn["answer"]
-            is_err = turn.get("is_error", False)
-            b_cls  = "bubble-err" if is_err else "bubble-ai"
-            lbl_ai = "" if is_err else '<div class="lbl lbl-ai"><span class="ai-dot"></span>Assistant</div>'
+        # Render all committed history (one cached element)
+        if history:
             st.markdown(
-                f'<div class="bubble-user-wrap"><div class="bubble-user"><div class="lbl">You</div>{q}</div></div>',
-                unsafe_allow_html=True
-            )
-            st.markdown(
-                f'<div class="bubble-ai-wrap"><div class="{b_cls}">{lbl_ai}{a}</div></div>',
+                _history_html(tuple(
+                    (t["question"], t["answer"], t.get("is_error", False)) for t in history
+                )),
                 unsafe_allow_html=True
             )
 
         # If there is a pending question, show its user bubble + a live AI slot
         if st.session_state.pending_q:
-            pq = st.session_state.pending_q
-            st.markdown(
-                f'<div class="bubble-user-wrap"><div class="bubble-user"><div class="lbl">You</div>{pq}</div></div>',
-                unsafe_allow_html=True
-            )
+            st.markdown(user_bubble(st.session_state.pending_q), unsafe_allow_html=True)
             ai_slot = st.empty()
 
+# The page so far is already on its way to the browser: load the backend meanwhile
+_start_prewarm()
+
 
 # ─── Input bar ───────────────────────────────────────────────────────────────
 if ready:
@@ -355,19 +437,24 @@ if ready:
 
     # ── Step 2: Pending question exists → stream AI response inside the container ──
     if st.session_state.pending_q:
+        from langchain_core.messages import HumanMessage
+
         pq           = st.session_state.pending_q
         full_response = ""
         is_err        = False
+        turn_started  = time.perf_counter()
+        renderer      = StreamRenderer(ai_slot)
+        rb            = backend()
 
         try:
-            for chunk, metadata in chatbot.stream(
+            for chunk, metadata in rb.chatbot.stream(
                 {"messages": [HumanMessage(content=pq)]},
                 config=config,
                 stream_mode="messages"
             ):
                 if st.session_state.get("stop_stream"):
                     break
-                if metadata.get("langgraph_node") == "chat_node":
+                if metadata.get("langgraph_node") in rb.ANSWER_NODES:
                     token = ""
                     if isinstance(chunk.content, str):
                         token = chunk.content
@@ -376,26 +463,20 @@ if ready:
                             if isinstance(block, dict) and "text" in block:
                                 token += block["text"]
                     if token:
-                        full_response += token
-                        ai_slot.markdown(
-                            f'<div class="bubble-ai-wrap"><div class="bubble-ai">'
-                            f'<div class="lbl lbl-ai"><span class="ai-dot"></span>Assistant</div>'
-                            f'{full_response}&#9646;</div></div>',
-                            unsafe_allow_html=True
-                        )
-
-            # Remove cursor
+                        if not renderer.text:
+                            observe("ui.ttft", time.perf_counter() - turn_started)
+                        renderer.push(token)
+
+            observe("ui.stream", time.perf_counter() - turn_started)
+            full_response = renderer.text
+
+            # Last frame: pending tokens, cursor removed
             if full_response:
-                ai_slot.markdown(
-                    f'<div class="bubble-ai-wrap"><div class="bubble-ai">'
-                    f'<div class="lbl lbl-ai"><span class="ai-dot"></span>Assistant</div>'
-                    f'{full_response}</div></div>',
-                    unsafe_allow_html=True
-                )
+                renderer.close()
 
             # Fallback invoke if stream returned nothing
             if not full_response and not st.session_state.get("stop_stream"):
-                result = chatbot.invoke(
+                result = rb.chatbot.invoke(
                     {"messages": [HumanMessage(content=pq)]}, config=config
                 )
                 raw = result["messages"][-1].content
@@ -403,12 +484,7 @@ if ready:
                     "".join(b["text"] for b in raw if isinstance(b, dict) and "text" in b)
                     if isinstance(raw, list) else raw
                 )
-                ai_slot.markdown(
-                    f'<div class="bubble-ai-wrap"><div class="bubble-ai">'
-                    f'<div class="lbl lbl-ai"><span class="ai-dot"></span>Assistant</div>'
-                    f'{full_response}</div></div>',
-                    unsafe_allow_html=True
-                )
+                ai_slot.markdown(ai_bubble(full_response), unsafe_allow_html=True)
 
         except Exception as e:
             err = str(e)
@@ -419,10 +495,7 @@ if ready:
             else:
                 full_response = "An error occurred. Please try again."
             is_err = True
-            ai_slot.markdown(
-                f'<div class="bubble-ai-wrap"><div class="bubble-err">{full_response}</div></div>',
-                unsafe_allow_html=True
-            )
+            ai_slot.markdown(ai_bubble(full_response, error=True), unsafe_allow_html=True)
 
         # Commit to history, clear pending, rerun to refresh container
         if full_response:
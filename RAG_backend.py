@@ -1,264 +1,3269 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import io
+import json
 import os
+import re
+import shutil
 import sqlite3
-import tempfile
+import threading
 import time
-from typing import Annotated, Any, Dict, List, Optional, TypedDict
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Annotated, Any, AsyncIterator, Dict, Iterator, List, NotRequired, Optional, Sequence, TypedDict
+import numpy as np
 import streamlit as st
 
+from dotenv import load_dotenv
+
+from metrics import observe, span, start_exporters
+
+if TYPE_CHECKING:
+    # FAISS, LangChain and LangGraph (~1.5 s to import) are imported inside the
+    # functions that use them, so importing this module stays cheap
+    import faiss
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.messages import BaseMessage
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from langgraph.graph.message import add_messages
+
+
+load_dotenv()
+start_exporters()  # METRICS_FILE / METRICS_PORT, if configured
+
+# langchain_google_genai needs GOOGLE_API_KEY; support GEMINI_API_KEY as alias
+if not os.getenv("GOOGLE_API_KEY") and os.getenv("GEMINI_API_KEY"):
+    os.environ["GOOGLE_API_KEY"] = os.environ["GEMINI_API_KEY"]
+
+# -------------------
+# 1. LLM + embeddings  (cached so they're built only ONCE per server lifetime)
+# -------------------
+@st.cache_resource(show_spinner=False)
+def _load_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# "remote" = HF Inference API (or EMBEDDING_ENDPOINT), "local" = in-process CPU
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "remote")
+# Optional feature-extraction URL (self-hosted TEI, or stub_embedding_server.py)
+EMBEDDING_ENDPOINT = os.getenv("EMBEDDING_ENDPOINT")
+# Local backend tuning
+EMBEDDING_RUNTIME = os.getenv("EMBEDDING_RUNTIME", "torch")  # "torch" | "onnx"
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "0") == "1"  # int8 weights
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 0 = library default
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8192"))
+EMBEDDING_ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_qint8_avx2.onnx")
+# Cache namespace: vectors are only reused from the backend that produced them.
+# Quantized vectors differ slightly, and a custom endpoint may serve another
+# model entirely (stub_embedding_server.py returns hash vectors)
+if EMBEDDING_BACKEND == "local":
+    EMBEDDING_MODEL_ID = f"{EMBEDDING_MODEL}+int8" if EMBEDDING_QUANTIZE else EMBEDDING_MODEL
+elif EMBEDDING_ENDPOINT:
+    EMBEDDING_MODEL_ID = f"{EMBEDDING_MODEL}@{EMBEDDING_ENDPOINT.rstrip('/')}"
+else:
+    EMBEDDING_MODEL_ID = EMBEDDING_MODEL
+
+
+def _local_embeddings(**overrides) -> Embeddings:
+    """In-process client configured from the EMBEDDING_* settings, with ``overrides`` applied."""
+    from embedding_clients import LocalEmbeddings
+
+    settings = {
+        "model_name": EMBEDDING_MODEL,
+        "runtime": EMBEDDING_RUNTIME,
+        "quantize": EMBEDDING_QUANTIZE,
+        "threads": EMBEDDING_THREADS,
+        "batch_tokens": EMBEDDING_BATCH_TOKENS,
+        "onnx_int8_file": EMBEDDING_ONNX_INT8_FILE,
+    }
+    return LocalEmbeddings(**{**settings, **overrides})
+
+
+def _build_embeddings(backend: str = EMBEDDING_BACKEND) -> Embeddings:
+    """Construct the embedding client for ``backend`` ("remote" or "local")."""
+    if backend == "local":
+        return _local_embeddings()
+    if backend != "remote":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend!r}")
+    if EMBEDDING_ENDPOINT:
+        from embedding_clients import HTTPEndpointEmbeddings
+
+        return HTTPEndpointEmbeddings(EMBEDDING_ENDPOINT, os.environ.get("HF_TOKEN"))
+    from langchain_huggingface import HuggingFaceEndpointEmbeddings
+
+    return HuggingFaceEndpointEmbeddings(
+        huggingfacehub_api_token=os.environ.get("HF_TOKEN"),
+        model=EMBEDDING_MODEL
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _load_embeddings():
+    return _build_embeddings(EMBEDDING_BACKEND)
+
+
+# The model clients, the on-disk stores (embedding cache, index store,
+# checkpointer) and the compiled graph are built on first use rather than at
+# import, so a cold server can paint its first page before paying for the
+# Gemini/HF SDKs, and importing this module creates no files. "eager" builds
+# them all at import (the old behaviour); long-running servers call prewarm()
+# on a background thread instead.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+
+_LAZY_ATTRS = {
+    "llm": lambda: _load_llm(),
+    "embeddings": lambda: _load_embeddings(),
+    "llm_with_tools": lambda: _lazy("llm").bind_tools(_lazy("tools")),
+    "tools": lambda: _build_tools(),
+    "rag_tool": lambda: _lazy("tools")[0],
+    "tool_node": lambda: _build_tool_node(),
+    "embedding_cache": lambda: _load_embedding_cache(),
+    "index_store": lambda: _load_index_store(),
+    "checkpointer": lambda: _load_checkpointer(),
+    "thread_registry": lambda: _lazy("checkpointer").registry,
+    "chatbot": lambda: _build_chatbot(),
+}
+_lazy_lock = threading.RLock()
+
+
+def _lazy(name: str):
+    """
+    Module attribute ``name``, built once on first use.
+
+    Assigning the attribute (``rb.llm = FakeChatModel()``) replaces it, as
+    before; code in this module reads these through ``_lazy`` so overrides apply.
+    """
+    value = globals().get(name)
+    if value is None:
+        with _lazy_lock:
+            value = globals().get(name)
+            if value is None:
+                started = time.perf_counter()
+                value = globals()[name] = _LAZY_ATTRS[name]()
+                observe(f"startup.{name}", time.perf_counter() - started)
+    return value
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRS:
+        return _lazy(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def prewarm() -> dict:
+    """Build every deferred client and the chat graph now; seconds per attribute."""
+    timings = {}
+    for name in _LAZY_ATTRS:
+        started = time.perf_counter()
+        _lazy(name)
+        timings[name] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+# -------------------
+# 1b. Embedding cache  (content-addressed, survives restarts)
+# -------------------
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embeddings_cache.db")
+EMBED_CACHE_MAX_MB = float(os.getenv("EMBED_CACHE_MAX_MB", "256"))
+EMBED_CACHE_DTYPE = os.getenv("EMBED_CACHE_DTYPE", "float16")  # or "float32"
+
+
+class _EmbeddingCache:
+    """
+    SQLite-backed store of embedding vectors keyed by sha256(model, dtype, text).
+
+    Vectors are kept as compact float16/float32 blobs. Once the stored vectors
+    exceed ``max_bytes`` the least recently used rows are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int, dtype: str = "float16"):
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)"
+        )
+        self.conn.commit()
+        row = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()
+        self.total_bytes = int(row[0])
+
+    def key(self, text: str, model: str = EMBEDDING_MODEL_ID) -> str:
+        raw = f"{model}\0{self.dtype.name}\0{text}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def encode(self, vector: List[float]) -> bytes:
+        return np.asarray(vector, dtype=self.dtype).tobytes()
+
+    def decode(self, blob: bytes) -> List[float]:
+        return np.frombuffer(blob, dtype=self.dtype).astype(np.float32).tolist()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached vectors for ``keys`` (missing keys are simply absent)."""
+        unique = list(dict.fromkeys(keys))
+        found: Dict[str, List[float]] = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(unique), 500):
+                part = unique[i : i + 500]
+                marks = ",".join("?" * len(part))
+                rows = self.conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = self.decode(blob)
+                if rows:
+                    self.conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})",
+                        [now, *part],
+                    )
+            self.conn.commit()
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items: Dict[str, bytes]) -> None:
+        """Store already-encoded vectors and evict LRU rows if over budget."""
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            cur = self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vec, last_used) VALUES (?, ?, ?)",
+                [(k, blob, now) for k, blob in items.items()],
+            )
+            # Approximate: every row of a batch has the same vector size
+            self.total_bytes += cur.rowcount * len(next(iter(items.values())))
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        # Drop the oldest ~10% below the budget so we don't evict on every insert
+        target = int(self.max_bytes * 0.9)
+        row = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()
+        count, total = int(row[0]), int(row[1])
+        if count == 0 or total <= target:
+            self.total_bytes = total
+            return
+        avg = total / count
+        n = min(count, int((total - target) / avg) + 1)
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (n,),
+        )
+        self.evictions += n
+        self.total_bytes = int(
+            self.conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0]
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": int(entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "dtype": self.dtype.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def _load_embedding_cache():
+    return _EmbeddingCache(
+        EMBED_CACHE_PATH, int(EMBED_CACHE_MAX_MB * 1024 * 1024), EMBED_CACHE_DTYPE
+    )
+
+
+def embedding_cache_stats() -> dict:
+    """Lifetime hit/miss counters and size of the embedding cache."""
+    return _lazy("embedding_cache").stats()
+
+# -------------------
+# 1c. Embedding scheduler  (concurrent batches + adaptive rate limiting)
+# -------------------
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", "4"))
+EMBED_RATE_PER_SEC = float(os.getenv("EMBED_RATE_PER_SEC", "2"))
+EMBED_MIN_BATCH = int(os.getenv("EMBED_MIN_BATCH", "8"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "128"))
+
+
+def _throttle_info(exc: Exception) -> tuple[Optional[int], Optional[float]]:
+    """Extract (HTTP status, Retry-After seconds) from an embedding client error."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        text = str(exc)
+        status = 429 if "429" in text else 503 if "503" in text else None
+    retry_after = None
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value:
+        try:
+            retry_after = float(value)
+        except ValueError:
+            try:
+                retry_after = max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                retry_after = None
+    return status, retry_after
+
+
+class _AdaptiveRateLimiter:
+    """
+    Token bucket whose refill rate adapts to the endpoint (AIMD).
+
+    Every success nudges the rate up additively; a 429/503 halves it and, when
+    the server sends Retry-After, blocks all callers until that time has passed.
+    """
+
+    def __init__(self, rate: float, burst: float, min_rate: float = 0.2, max_rate: float = 50.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(min(delay, 1.0))
+
+    def on_success(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.25)
+
+    def on_throttle(self, retry_after: Optional[float]) -> None:
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            pause = retry_after if retry_after is not None else 1.0 / self.rate
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _EmbeddingScheduler:
+    """
+    Keeps several embedding batches in flight against a rate-limited endpoint.
+
+    Batch size grows while requests succeed and halves on throttling; failed
+    batches are re-queued (and re-split if the batch size shrank). Results are
+    written back by offset, so output order always matches input order.
+
+    The in-flight cap, rate and batch size belong to the scheduler, not to an
+    ``embed`` call: concurrent ingests share them, so the endpoint never sees
+    more than ``max_in_flight`` requests from this process.
+    """
+
+    def __init__(
+        self,
+        embed_fn,
+        max_in_flight: int = EMBED_MAX_IN_FLIGHT,
+        rate: float = EMBED_RATE_PER_SEC,
+        min_batch: int = EMBED_MIN_BATCH,
+        max_batch: int = EMBED_MAX_BATCH,
+    ):
+        self.embed_fn = embed_fn
+        self.max_in_flight = max(1, max_in_flight)
+        self.limiter = _AdaptiveRateLimiter(rate, burst=self.max_in_flight)
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_size = min_batch
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        self.texts = 0
+        self.batches = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.active_runs = 0
+        self.busy_seconds = 0.0
+        self.last_run: dict = {}
+
+    def _call(self, batch: List[str]) -> List[List[float]]:
+        with span("embed.slot_wait"):  # other embed() calls may hold every slot
+            self.slots.acquire()
+        try:
+            with span("embed.rate_limit_wait"):  # includes backoff after 429/503
+                self.limiter.acquire()
+            with self.lock:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                with span("embed.request"):
+                    return self.embed_fn(batch)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        finally:
+            self.slots.release()
+
+    def _resize(self, grow: bool) -> None:
+        with self.lock:
+            if grow:
+                self.batch_size = min(self.max_batch, int(self.batch_size * 1.25) + 1)
+            else:
+                self.batch_size = max(self.min_batch, self.batch_size // 2)
+
+    def _next_batch_size(self, cap: Optional[int]) -> int:
+        with self.lock:
+            return max(1, min(self.batch_size, cap) if cap else self.batch_size)
+
+    def embed(
+        self,
+        texts: List[str],
+        batch_size: Optional[int] = None,
+        max_retries: int = 5,
+        on_batch=None,
+    ) -> List[List[float]]:
+        """
+        Embed ``texts`` in order; ``on_batch(start, vectors)`` fires per finished
+        batch. ``batch_size`` caps this call's batches without touching the
+        shared adaptive size.
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        retry_queue: deque = deque()
+        cursor = 0
+        throttles = 0
+        started = time.perf_counter()
+        with self.lock:
+            self.active_runs += 1
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            in_flight: dict = {}
+            try:
+                while cursor < len(texts) or retry_queue or in_flight:
+                    while len(in_flight) < self.max_in_flight and (retry_queue or cursor < len(texts)):
+                        if retry_queue:
+                            start, end, attempt = retry_queue.popleft()
+                        else:
+                            size = self._next_batch_size(batch_size)
+                            start, end, attempt = cursor, min(len(texts), cursor + size), 0
+                            cursor = end
+                        future = pool.submit(self._call, texts[start:end])
+                        in_flight[future] = (start, end, attempt)
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        start, end, attempt = in_flight.pop(future)
+                        try:
+                            vectors = future.result()
+                        except Exception as e:
+                            if attempt + 1 >= max_retries:
+                                raise
+                            with self.lock:
+                                self.retries += 1
+                            status, retry_after = _throttle_info(e)
+                            if status in (429, 503):
+                                throttles += 1
+                                self.limiter.on_throttle(retry_after)
+                                self._resize(grow=False)
+                            else:
+                                # Unknown failure: back off exponentially, keep the rate
+                                self.limiter.pause(2 ** (attempt + 1))
+                            step = self._next_batch_size(batch_size)
+                            for s in range(start, end, step):
+                                retry_queue.append((s, min(end, s + step), attempt + 1))
+                            continue
+                        results[start:end] = vectors
+                        self.limiter.on_success()
+                        self._resize(grow=True)
+                        with self.lock:
+                            self.texts += end - start
+                            self.batches += 1
+                        if on_batch is not None:
+                            on_batch(start, vectors)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+                with self.lock:
+                    self.active_runs -= 1
+        elapsed = time.perf_counter() - started
+        run = {
+            "texts": len(texts),
+            "seconds": elapsed,
+            "texts_per_sec": (len(texts) / elapsed) if elapsed > 0 else 0.0,
+            "throttles": throttles,
+        }
+        with self.lock:
+            self.busy_seconds += elapsed
+            self.last_run = run
+        return results
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "texts": self.texts,
+                "batches": self.batches,
+                "retries": self.retries,
+                "throttles": self.limiter.throttles,
+                "rate_per_sec": self.limiter.rate,
+                "batch_size": self.batch_size,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "active_runs": self.active_runs,
+                "texts_per_sec": (self.texts / self.busy_seconds) if self.busy_seconds else 0.0,
+                "last_run": dict(self.last_run),
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def _load_embedding_scheduler():
+    # Resolve the module-level client at call time so it can be swapped out
+    return _EmbeddingScheduler(lambda batch: _lazy("embeddings").embed_documents(batch))
+
+embedding_scheduler = _load_embedding_scheduler()
+
+
+def embedding_scheduler_stats() -> dict:
+    """Throughput, retry and adaptive rate/batch-size state of the embedding scheduler."""
+    return embedding_scheduler.stats()
+
+
+# -------------------
+# 1d. BM25 index  (NumPy inverted index, replaces rank_bm25)
+# -------------------
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class _BM25Index:
+    """
+    Okapi BM25 over a term-major inverted index held in flat NumPy arrays.
+
+    Terms are interned to integer ids. The postings of term ``t`` are
+    ``doc_ids[indptr[t]:indptr[t + 1]]`` with matching ``tfs`` (a CSC
+    term-document matrix), so a query only touches the postings of its own
+    terms and is scored with vectorised array ops; top-k uses argpartition.
+    Only raw counts are stored, so idf/avgdl can come from a larger
+    collection that this index is one segment of.
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.total_len = int(doc_len.sum())
+
+    def query_terms(self, query: str) -> Dict[str, int]:
+        """Query term frequencies, restricted to terms this index contains."""
+        counts: Dict[str, int] = {}
+        for token in _tokenize(query):
+            if token in self.vocab:
+                counts[token] = counts.get(token, 0) + 1
+        return counts
+
+    def doc_freq(self, term: str) -> int:
+        tid = self.vocab.get(term)
+        return 0 if tid is None else int(self.indptr[tid + 1] - self.indptr[tid])
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str], **kwargs) -> "_BM25Index":
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        doc_len = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            tokens = _tokenize(text)
+            doc_len[doc_id] = len(tokens)
+            counts: Dict[int, int] = {}
+            for token in tokens:
+                tid = vocab.setdefault(token, len(vocab))
+                counts[tid] = counts.get(tid, 0) + 1
+            term_ids.extend(counts)
+            doc_ids.extend([doc_id] * len(counts))
+            tfs.extend(counts.values())
+        terms = np.asarray(term_ids, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")  # stable keeps doc ids ascending per term
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=indptr[1:])
+        return cls(
+            vocab,
+            indptr,
+            np.asarray(doc_ids, dtype=np.int32)[order],
+            np.asarray(tfs, dtype=np.int32)[order],
+            doc_len,
+            **kwargs,
+        )
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.indptr, self.doc_ids, self.tfs, self.doc_len)
+        return sum(a.nbytes for a in arrays) + sum(len(t) + 60 for t in self.vocab)
+
+    def get_scores(self, query: str, stats: Optional[tuple] = None) -> np.ndarray:
+        """
+        BM25 score of every document for ``query``.
+
+        ``stats`` is an optional ``(n_docs, avgdl, {term: df})`` triple of
+        collection-wide statistics, so several indexes can be scored as if
+        they were one corpus; by default this index's own statistics are used.
+        """
+        if stats is None:
+            n = len(self.doc_len)
+            stats = (n, self.total_len / n if n else 1.0, None)
+        n_docs, avgdl, df_map = stats
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        for term, qtf in self.query_terms(query).items():
+            tid = self.vocab[term]
+            lo, hi = self.indptr[tid], self.indptr[tid + 1]
+            df = df_map[term] if df_map is not None else hi - lo
+            idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+            docs = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / max(avgdl, 1e-9))
+            scores[docs] += qtf * idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def top_k(self, query: str, k: int, stats: Optional[tuple] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return ``(doc_ids, scores)`` of the k best matching documents, best first."""
+        scores = self.get_scores(query, stats)
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] > 0]  # no shared terms, no match
+        return top, scores[top]
+
+    _ARRAYS = ("indptr", "doc_ids", "tfs", "doc_len")
+
+    def save(self, path: str) -> None:
+        # One .npy per array so they can be memory-mapped on load
+        for name in self._ARRAYS:
+            np.save(os.path.join(path, f"bm25_{name}.npy"), getattr(self, name))
+        terms = sorted(self.vocab, key=self.vocab.__getitem__)
+        with open(os.path.join(path, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "terms": terms}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "_BM25Index":
+        with open(os.path.join(path, "bm25.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, f"bm25_{name}.npy"), mmap_mode="r") for name in cls._ARRAYS]
+        return cls({t: i for i, t in enumerate(meta["terms"])}, *arrays, k1=meta["k1"], b=meta["b"])
+
+
+# -------------------
+# 2. Knowledge-base store (shared per-document segments, referenced by threads)
+# -------------------
+INDEX_DIR = os.getenv("INDEX_DIR", "indexes")
+INDEX_STORE_MAX_MB = float(os.getenv("INDEX_STORE_MAX_MB", "512"))
+
+
+# Index type per document: "auto" picks by chunk count; or force flat|hnsw|sq8|fp16|ivfsq8|ivfpq
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+FAISS_HNSW_MIN_CHUNKS = int(os.getenv("FAISS_HNSW_MIN_CHUNKS", "5000"))
+FAISS_IVF_MIN_CHUNKS = int(os.getenv("FAISS_IVF_MIN_CHUNKS", "50000"))
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+# Search-time accuracy/speed knobs (see set_faiss_search_params)
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+
+FAISS_INDEX_TYPES = ("flat", "hnsw", "sq8", "fp16", "ivfsq8", "ivfpq")
+if FAISS_INDEX_TYPE not in FAISS_INDEX_TYPES + ("auto",):
+    # Fail at startup, not after a whole document has been parsed and embedded
+    raise ValueError(
+        f"Unknown FAISS_INDEX_TYPE: {FAISS_INDEX_TYPE!r} (expected 'auto' or one of {FAISS_INDEX_TYPES})"
+    )
+
+
+def choose_faiss_index_type(n_chunks: int) -> str:
+    """
+    Exact search while it's cheap; graph / compressed indexes for large documents.
+
+    IVF-PQ is the smallest (~56 bytes per chunk) but trains slowly and loses
+    recall on sentence embeddings (see ``benchmark.py faiss``), so the auto
+    policy stops at IVF + 8-bit scalar quantization; set FAISS_INDEX_TYPE=ivfpq
+    when memory matters more than recall.
+    """
+    if FAISS_INDEX_TYPE != "auto":
+        return FAISS_INDEX_TYPE
+    if n_chunks >= FAISS_IVF_MIN_CHUNKS:
+        return "ivfsq8"
+    if n_chunks >= FAISS_HNSW_MIN_CHUNKS:
+        return "hnsw"
+    return "flat"
+
+
+def _faiss_spec(kind: str, n: int, d: int) -> str:
+    nlist = max(1, min(4096, int(4 * n ** 0.5), n // 39))  # >= 39 training points per list
+    if kind == "ivfsq8":
+        return f"IVF{nlist},SQ8" if n >= 1024 else "SQ8"
+    if kind == "ivfpq":
+        # PQ trains 256 centroids per sub-quantizer; too few vectors -> scalar quantization
+        if n < 1024 or d % 8:
+            return "SQ8"
+        return f"IVF{nlist},PQ{d // 8}x8"
+    specs = {"flat": "Flat", "hnsw": f"HNSW{FAISS_HNSW_M},Flat", "sq8": "SQ8", "fp16": "SQfp16"}
+    if kind not in specs:
+        raise ValueError(f"Unknown FAISS index type: {kind!r} (expected one of {FAISS_INDEX_TYPES})")
+    return specs[kind]
+
+
+def build_faiss_index(vectors: np.ndarray, kind: str):
+    """Build (and train on the document's own vectors, if needed) a FAISS L2 index."""
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    index = faiss.index_factory(d, _faiss_spec(kind, n, d), faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    tune_faiss_index(index)
+    return index
+
+
+def tune_faiss_index(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> None:
+    """Apply efSearch (HNSW) / nprobe (IVF); a no-op for flat and SQ indexes."""
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search or FAISS_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(nprobe or FAISS_NPROBE, index.nlist)
+
+
+def faiss_index_type(index) -> str:
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfsq8"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "flat"
+
+
+def faiss_index_bytes(index) -> int:
+    """Approximate RAM held by a FAISS index (codes, graph links, centroids)."""
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return index.hnsw.neighbors.size() * 4 + faiss_index_bytes(index.storage)
+    if isinstance(index, faiss.IndexIVF):
+        codebooks = index.pq.centroids.size() * 4 if hasattr(index, "pq") else 0
+        return index.ntotal * (index.code_size + 8) + index.nlist * index.d * 4 + codebooks
+    return index.ntotal * getattr(index, "code_size", index.d * 4)
+
+
+class _ChunkStore:
+    """
+    A document's chunk texts as one UTF-8 buffer plus an offsets array.
+
+    Page numbers are one int32 per chunk; source, doc id and page labels are
+    stored once per document. Opened from disk, the buffer and arrays are
+    memory-mapped. ``document(i)`` builds the LangChain ``Document`` for a
+    single chunk when it is needed.
+    """
+
+    __slots__ = ("buffer", "offsets", "pages", "page_labels", "source", "doc_id", "total_pages")
+
+    def __init__(self, buffer, offsets, pages, page_labels, source, doc_id, total_pages):
+        self.buffer = buffer  # uint8 array (or memmap) of concatenated UTF-8 texts
+        self.offsets = offsets  # int64, len(chunks) + 1
+        self.pages = pages  # int32 per chunk
+        self.page_labels = page_labels  # one label per page of the PDF
+        self.source = source
+        self.doc_id = doc_id
+        self.total_pages = total_pages
+
+    @classmethod
+    def from_chunks(cls, texts: List[str], metadatas: List[dict]) -> "_ChunkStore":
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        first = metadatas[0] if metadatas else {}
+        total_pages = int(first.get("total_pages", 0))
+        labels = [str(p + 1) for p in range(total_pages)]
+        for meta in metadatas:
+            if meta.get("page", total_pages) < total_pages:
+                labels[meta["page"]] = meta.get("page_label", labels[meta["page"]])
+        return cls(
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            offsets,
+            np.asarray([m.get("page", 0) for m in metadatas], dtype=np.int32),
+            labels,
+            first.get("source", ""),
+            first.get("doc_id", ""),
+            total_pages,
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.text(i) for i in range(len(self)))
+
+    def text(self, i: int) -> str:
+        return self.buffer[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def metadata(self, i: int) -> dict:
+        page = int(self.pages[i])
+        return {
+            "source": self.source,
+            "page": page,
+            "page_label": self.page_labels[page] if page < len(self.page_labels) else str(page + 1),
+            "total_pages": self.total_pages,
+            "doc_id": self.doc_id,
+            "chunk_id": int(i),
+        }
+
+    def document(self, i: int) -> Document:
+        from langchain_core.documents import Document
+
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes + self.offsets.nbytes + self.pages.nbytes
+
+    def save(self, path: str) -> None:
+        self.buffer.tofile(os.path.join(path, "chunks.bin"))
+        np.save(os.path.join(path, "chunk_offsets.npy"), self.offsets)
+        np.save(os.path.join(path, "chunk_pages.npy"), self.pages)
+        with open(os.path.join(path, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "source": self.source,
+                    "doc_id": self.doc_id,
+                    "total_pages": self.total_pages,
+                    "page_labels": self.page_labels,
+                },
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "_ChunkStore":
+        with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(path, "chunk_offsets.npy"), mmap_mode="r")
+        # np.memmap refuses empty files
+        buffer = (
+            np.memmap(os.path.join(path, "chunks.bin"), dtype=np.uint8, mode="r")
+            if offsets[-1]
+            else np.empty(0, dtype=np.uint8)
+        )
+        return cls(
+            buffer,
+            offsets,
+            np.load(os.path.join(path, "chunk_pages.npy"), mmap_mode="r"),
+            meta["page_labels"],
+            meta["source"],
+            meta["doc_id"],
+            meta["total_pages"],
+        )
+
+
+class _ChunkStoreBuilder:
+    """
+    Appends chunks during ingest straight into the ``_ChunkStore`` layout.
+
+    Texts go into one growing UTF-8 buffer, so a document being indexed holds
+    no per-chunk ``str`` or metadata dict beyond the group being embedded.
+    """
+
+    __slots__ = ("buffer", "offsets", "pages", "page_labels", "source", "doc_id", "total_pages")
+
+    def __init__(self, source: str, doc_id: str):
+        self.buffer = bytearray()
+        self.offsets = array("q", [0])
+        self.pages = array("i")
+        self.page_labels: List[str] = []
+        self.source = source
+        self.doc_id = doc_id
+        self.total_pages = 0
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def add_page(self, page: int, label: str, total_pages: int) -> None:
+        self.total_pages = total_pages
+        if len(self.page_labels) < total_pages:
+            self.page_labels.extend(str(p + 1) for p in range(len(self.page_labels), total_pages))
+        self.page_labels[page] = label
+
+    def add(self, text: str, page: int) -> int:
+        """Append one chunk and return its id."""
+        self.buffer += text.encode("utf-8")
+        self.offsets.append(len(self.buffer))
+        self.pages.append(page)
+        return len(self.pages) - 1
+
+    def build(self) -> _ChunkStore:
+        """The finished store, as views over this builder's buffers (no copy); stop adding after."""
+        return _ChunkStore(
+            np.frombuffer(self.buffer, dtype=np.uint8),
+            np.frombuffer(self.offsets, dtype=np.int64),
+            np.frombuffer(self.pages, dtype=np.int32),
+            self.page_labels,
+            self.source,
+            self.doc_id,
+            self.total_pages,
+        )
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(value))
+
+
+class _ThreadIndexStore:
+    """
+    Durable knowledge bases built from shared, immutable document segments.
+
+    Every distinct PDF (by content hash) is indexed once into a segment
+    directory under ``root/segments/`` holding its raw FAISS index, BM25
+    arrays and chunk store. Segment files are never modified after publish,
+    so every process serving ``root`` (Streamlit workers, replicas on a
+    shared volume) opens them memory-mapped and the OS page cache holds a
+    single copy for all of them.
+
+    ``root/manifest.db`` (SQLite, WAL) is the only mutable state: the current
+    segment version of each document and each thread's document list. A
+    segment becomes visible when its manifest row commits, so publishing is
+    atomic across processes. A document referenced by no thread has its row
+    and files deleted.
+
+    Only the most recently used segments are kept open, up to ``max_bytes``
+    of estimated index size; evicted segments are reopened on demand.
+    """
+
+    # Unreferenced segment directories older than this are leftovers of a crash
+    ORPHAN_SECONDS = 3600
+
+    def __init__(self, root: str, max_bytes: int):
+        from sqlite_saver import connect as sqlite_connect
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self._resident: "OrderedDict[str, tuple[int, dict, int]]" = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.shared_attaches = 0
+        os.makedirs(os.path.join(root, "segments"), exist_ok=True)
+        self.db = sqlite_connect(os.path.join(root, "manifest.db"))
+        self.db.isolation_level = None  # explicit BEGIN IMMEDIATE for writes
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                info TEXT NOT NULL,
+                published_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS thread_files (
+                thread_id TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                added_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, doc_id)
+            );
+            CREATE INDEX IF NOT EXISTS thread_files_by_doc ON thread_files (doc_id);
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                extra TEXT NOT NULL DEFAULT '{}'
+            );
+            """
+        )
+        self._collect_orphans()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _estimate_bytes(segment: dict) -> int:
+        return faiss_index_bytes(segment["faiss"]) + segment["chunks"].nbytes + segment["bm25"].nbytes
+
+    def _delete_files(self, rel_paths: List[str]) -> None:
+        # Other processes may still have these mapped; POSIX keeps unlinked mappings valid
+        for rel in rel_paths:
+            shutil.rmtree(os.path.join(self.root, rel), ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(os.path.join(self.root, rel)))  # the doc's dir, once empty
+            except OSError:
+                pass
+
+    def _forget_resident(self, doc_ids) -> None:
+        with self.lock:
+            for doc_id in doc_ids:
+                resident = self._resident.pop(doc_id, None)
+                if resident is not None:
+                    self.resident_bytes -= resident[2]
+
+    # -- shared documents -------------------------------------------------
+    def has_document(self, doc_id: str) -> bool:
+        return bool(self._query("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)))
+
+    def document_info(self, doc_id: str) -> dict:
+        rows = self._query("SELECT info FROM documents WHERE doc_id = ?", (doc_id,))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def publish_document(self, doc_id: str, segment: dict, info: dict, replace: bool = False) -> bool:
+        """
+        Write a new immutable segment version for a document and make it current.
+
+        Without ``replace`` a document that is already published keeps its
+        current version (a concurrent identical upload loses the race
+        harmlessly). Returns True if this call's segment was published.
+        """
+        import faiss
+
+        if not replace and self.has_document(doc_id):
+            return False
+        rel = os.path.join("segments", _safe_name(doc_id), uuid.uuid4().hex)
+        path = os.path.join(self.root, rel)
+        os.makedirs(path)
+        faiss.write_index(segment["faiss"], os.path.join(path, "index.faiss"))
+        segment["bm25"].save(path)
+        segment["chunks"].save(path)
+        stale: List[str] = []
+        with self._transaction() as db:
+            row = db.execute("SELECT version, path FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is not None and not replace:
+                stale.append(rel)
+            else:
+                if row is not None:
+                    stale.append(row[1])
+                db.execute(
+                    "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                    (doc_id, (row[0] + 1) if row else 1, rel, json.dumps(info), time.time()),
+                )
+        self._delete_files(stale)
+        self._forget_resident([doc_id])
+        return rel not in stale
+
+    def _release_unreferenced(self, db: sqlite3.Connection, doc_ids) -> List[str]:
+        """Delete manifest rows of documents no thread uses; returns their segment paths."""
+        paths = []
+        for doc_id in doc_ids:
+            if db.execute("SELECT 1 FROM thread_files WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone():
+                continue
+            row = db.execute("SELECT path FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is not None:
+                paths.append(row[0])
+                db.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+        return paths
+
+    # -- thread knowledge bases -------------------------------------------
+    @staticmethod
+    def _bump(db: sqlite3.Connection, thread_id: str) -> None:
+        db.execute(
+            """
+            INSERT INTO threads (thread_id, version) VALUES (?, 1)
+            ON CONFLICT (thread_id) DO UPDATE SET version = version + 1
+            """,
+            (thread_id,),
+        )
+
+    def attach(self, thread_id: str, doc_id: str, filename: str) -> dict:
+        """Add a published document to a thread's knowledge base (takes a reference)."""
+        thread_id = str(thread_id)
+        with self._transaction() as db:
+            if not db.execute("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone():
+                raise KeyError(f"Unknown document {doc_id}")
+            others = db.execute(
+                "SELECT COUNT(*) FROM thread_files WHERE doc_id = ? AND thread_id != ?",
+                (doc_id, thread_id),
+            ).fetchone()[0]
+            db.execute(
+                "INSERT OR REPLACE INTO thread_files VALUES (?, ?, ?, ?)",
+                (thread_id, doc_id, filename, time.time()),
+            )
+            self._bump(db, thread_id)
+        if others:
+            self.shared_attaches += 1
+        return self.metadata(thread_id)
+
+    def remove_document(self, thread_id: str, doc_id: str) -> bool:
+        """Drop a document from a thread. Returns False if it wasn't there."""
+        thread_id = str(thread_id)
+        with self._transaction() as db:
+            removed = db.execute(
+                "DELETE FROM thread_files WHERE thread_id = ? AND doc_id = ?", (thread_id, doc_id)
+            ).rowcount
+            if not removed:
+                return False
+            self._bump(db, thread_id)
+            stale = self._release_unreferenced(db, [doc_id])
+        self._delete_files(stale)
+        if stale:
+            self._forget_resident([doc_id])
+        return True
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Release every document the thread references and forget the thread."""
+        thread_id = str(thread_id)
+        with self._transaction() as db:
+            doc_ids = [
+                row[0]
+                for row in db.execute("SELECT doc_id FROM thread_files WHERE thread_id = ?", (thread_id,))
+            ]
+            db.execute("DELETE FROM thread_files WHERE thread_id = ?", (thread_id,))
+            db.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+            stale = self._release_unreferenced(db, doc_ids)
+        self._delete_files(stale)
+        self._forget_resident(doc_ids)
+
+    # -- residency ----------------------------------------------------------
+    def _load(self, rel: str) -> Optional[dict]:
+        import faiss
+
+        path = os.path.join(self.root, rel)
+        if not os.path.exists(os.path.join(path, "chunks.json")):
+            return None
+        # Zero-copy for flat/SQ codes: index data stays in the shared page cache
+        index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC)
+        tune_faiss_index(index)
+        return {"faiss": index, "bm25": _BM25Index.load(path), "chunks": _ChunkStore.load(path)}
+
+    def _admit(self, doc_id: str, version: int, segment: dict) -> None:
+        if doc_id in self._resident:
+            self.resident_bytes -= self._resident.pop(doc_id)[2]
+        size = self._estimate_bytes(segment)
+        self._resident[doc_id] = (version, segment, size)
+        self.resident_bytes += size
+        # Always keep the segment we just admitted, even if it alone exceeds the budget
+        while self.resident_bytes > self.max_bytes and len(self._resident) > 1:
+            _, (_, _, evicted_size) = self._resident.popitem(last=False)
+            self.resident_bytes -= evicted_size
+            self.evictions += 1
+
+    def _segment(self, doc_id: str, version: int, rel: str) -> Optional[dict]:
+        with self.lock:
+            resident = self._resident.get(doc_id)
+            if resident is not None and resident[0] == version:
+                self._resident.move_to_end(doc_id)
+                self.hits += 1
+                return resident[1]
+            segment = self._load(rel)
+            if segment is None:
+                return None
+            self.loads += 1
+            self._admit(doc_id, version, segment)
+            return segment
+
+    def get(self, thread_id: Optional[str], document: Optional[str] = None) -> Optional[dict]:
+        """
+        Return ``{doc_id: segment}`` for a thread, opening segments on demand.
+
+        ``document`` restricts the result to one document, by doc_id or filename.
+        """
+        if not thread_id:
+            return None
+        rows = self._query(
+            """
+            SELECT f.doc_id, f.filename, d.version, d.path
+            FROM thread_files AS f JOIN documents AS d USING (doc_id)
+            WHERE f.thread_id = ? ORDER BY f.added_at
+            """,
+            (str(thread_id),),
+        )
+        segments = {}
+        for doc_id, filename, version, rel in rows:
+            if document and document not in (doc_id, filename):
+                continue
+            segment = self._segment(doc_id, version, rel)
+            if segment is not None:
+                segments[doc_id] = segment
+        return segments or None
+
+    def contains(self, thread_id: str) -> bool:
+        return bool(self._query("SELECT 1 FROM thread_files WHERE thread_id = ? LIMIT 1", (str(thread_id),)))
+
+    def threads(self) -> List[str]:
+        """Threads with at least one document."""
+        return [row[0] for row in self._query("SELECT DISTINCT thread_id FROM thread_files")]
+
+    def metadata(self, thread_id: str) -> dict:
+        thread_id = str(thread_id)
+        with self.lock:
+            files = self.db.execute(
+                """
+                SELECT f.doc_id, f.filename, d.info, f.added_at
+                FROM thread_files AS f JOIN documents AS d USING (doc_id)
+                WHERE f.thread_id = ? ORDER BY f.added_at
+                """,
+                (thread_id,),
+            ).fetchall()
+            row = self.db.execute(
+                "SELECT version, extra FROM threads WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        if row is None and not files:
+            return {}
+        metadata = json.loads(row[1]) if row else {}
+        metadata["version"] = row[0] if row else 0
+        metadata["files"] = []
+        for doc_id, filename, info, added_at in files:
+            info = json.loads(info)
+            metadata["files"].append(
+                {
+                    "doc_id": doc_id,
+                    "filename": filename,
+                    "pages": info["pages"],
+                    "chunks": info["chunks"],
+                    "added_at": added_at,
+                }
+            )
+        return metadata
+
+    def update_metadata(self, thread_id: str, **fields) -> dict:
+        """Merge ``fields`` into a thread's stored metadata."""
+        thread_id = str(thread_id)
+        with self._transaction() as db:
+            row = db.execute("SELECT extra FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+            extra = {**(json.loads(row[0]) if row else {}), **fields}
+            db.execute(
+                """
+                INSERT INTO threads (thread_id, extra) VALUES (?, ?)
+                ON CONFLICT (thread_id) DO UPDATE SET extra = excluded.extra
+                """,
+                (thread_id, json.dumps(extra)),
+            )
+        return self.metadata(thread_id)
+
+    def retune(self) -> None:
+        """Re-apply the FAISS search parameters to every resident segment."""
+        with self.lock:
+            for _, segment, _ in self._resident.values():
+                tune_faiss_index(segment["faiss"])
+
+    # -- maintenance ----------------------------------------------------------
+    def _collect_orphans(self) -> None:
+        """Remove segment directories no manifest row points at (crashed publishes)."""
+        live = {row[0] for row in self._query("SELECT path FROM documents")}
+        cutoff = time.time() - self.ORPHAN_SECONDS
+        segments_dir = os.path.join(self.root, "segments")
+        for doc_dir in os.listdir(segments_dir):
+            if not os.path.isdir(os.path.join(segments_dir, doc_dir)):
+                continue
+            for version_dir in os.listdir(os.path.join(segments_dir, doc_dir)):
+                rel = os.path.join("segments", doc_dir, version_dir)
+                if rel not in live and os.path.getmtime(os.path.join(self.root, rel)) < cutoff:
+                    shutil.rmtree(os.path.join(self.root, rel), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            documents, references = self.db.execute(
+                "SELECT (SELECT COUNT(*) FROM documents), (SELECT COUNT(*) FROM thread_files)"
+            ).fetchone()
+            return {
+                "documents": documents,
+                "references": references,
+                "shared_attaches": self.shared_attaches,
+                "resident_segments": len(self._resident),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def _load_index_store():
+    return _ThreadIndexStore(INDEX_DIR, int(INDEX_STORE_MAX_MB * 1024 * 1024))
+
+
+def _thread_files(thread_id) -> List[dict]:
+    """The thread's attached documents, as recorded in the index manifest."""
+    return _lazy("index_store").metadata(str(thread_id)).get("files", [])
+
+
+def _get_retriever(thread_id: Optional[str], document: Optional[str] = None):
+    """Fetch the per-document index segments for a thread if available."""
+    return _lazy("index_store").get(thread_id, document)
+
+
+def index_store_stats() -> dict:
+    """Resident size and hit/load/eviction counters of the knowledge-base store."""
+    return _lazy("index_store").stats()
+
+
+def set_faiss_search_params(nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> dict:
+    """Change IVF nprobe / HNSW efSearch for loaded and future segments."""
+    global FAISS_NPROBE, FAISS_EF_SEARCH
+    if nprobe:
+        FAISS_NPROBE = int(nprobe)
+    if ef_search:
+        FAISS_EF_SEARCH = int(ef_search)
+    _lazy("index_store").retune()
+    retrieval_cache.invalidate(())  # cached results were ranked with the old settings
+    return {"nprobe": FAISS_NPROBE, "ef_search": FAISS_EF_SEARCH}
+
+
+def _embed_with_retry(
+    texts: List[str],
+    batch_size: Optional[int] = None,
+    max_retries: int = 5,
+    stats: Optional[dict] = None,
+) -> List[List[float]]:
+    """
+    Embed text through the concurrent, rate-limited embedding scheduler.
+
+    Vectors already in the embedding cache are served locally; only the misses
+    are sent to the endpoint. If ``stats`` is given it receives this call's
+    cache ``hits``/``misses``/``hit_rate``.
+    """
+    cache = _lazy("embedding_cache")
+    keys = [cache.key(t) for t in texts]
+    vectors = cache.get_many(keys)
+    hits = sum(1 for k in keys if k in vectors)
+
+    # Identical chunks inside one document only need embedding once
+    pending: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in pending:
+            pending[key] = text
+    miss_keys = list(pending)
+    miss_texts = list(pending.values())
+
+    def _store(start: int, batch_embeddings: List[List[float]]) -> None:
+        encoded = {
+            key: cache.encode(vec)
+            for key, vec in zip(miss_keys[start : start + len(batch_embeddings)], batch_embeddings)
+        }
+        cache.put_many(encoded)
+        # Hand back the same precision the cache will serve next time
+        vectors.update({key: cache.decode(blob) for key, blob in encoded.items()})
+
+    client = _lazy("embeddings")
+    if miss_texts and getattr(client, "is_local", False):
+        # No network or quota in the way: one call, the backend batches by length
+        _store(0, client.embed_documents(miss_texts))
+    elif miss_texts:
+        embedding_scheduler.embed(
+            miss_texts, batch_size=batch_size, max_retries=max_retries, on_batch=_store
+        )
+
+    if stats is not None:
+        stats["hits"] = hits
+        stats["misses"] = len(texts) - hits
+        stats["hit_rate"] = (hits / len(texts)) if texts else 0.0
+    return [vectors[k] for k in keys]
+
+
+# Chunks are handed to the embedder in groups this size while parsing continues
+INGEST_EMBED_GROUP = int(os.getenv("INGEST_EMBED_GROUP", "64"))
+
+
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 150
+
+
+def _make_splitter() -> RecursiveCharacterTextSplitter:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=["\n\n", "\n", " ", ""]
+    )
+
+
+def _iter_pdf_pages(file_bytes: bytes, source: str) -> Iterator[tuple[int, Document]]:
+    """
+    Yield ``(total_pages, Document)`` per page, parsed straight from memory.
+
+    Large files are extracted on a process pool (see ``pdf_extract``);
+    pages still arrive in order with the same metadata either way.
+    """
+    from langchain_core.documents import Document
+
+    from pypdf import PdfReader
+
+    from pdf_extract import iter_page_texts
+
+    reader = PdfReader(io.BytesIO(file_bytes))
+    total = len(reader.pages)
+    try:
+        labels = reader.page_labels
+    except Exception:  # malformed /PageLabels trees are common; fall back to numbers
+        labels = []
+    texts = iter_page_texts(file_bytes, reader=reader)
+    try:
+        for i, text in enumerate(texts):
+            yield total, Document(
+                page_content=text,
+                metadata={
+                    "source": source,
+                    "page": i,
+                    "page_label": labels[i] if i < len(labels) else str(i + 1),
+                    "total_pages": total,
+                },
+            )
+    finally:
+        texts.close()
+
+
+def _timed(iterable, timings: dict, key: str):
+    """Yield from ``iterable``, adding the time spent producing items to ``timings[key]``."""
+    iterator = iter(iterable)
+    try:
+        while True:
+            tick = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timings[key] += time.perf_counter() - tick
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()  # closed early: let the source release its workers now
+
+
+class IngestJobCancelled(Exception):
+    pass
+
+
+def ingest_pdf_stream(
+    file_bytes: bytes,
+    thread_id: str,
+    filename: Optional[str] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[dict]:
+    """
+    Parse, split, embed and index a PDF as a pipeline, yielding progress events.
+
+    The PDF is added to the thread's knowledge base as a new document; the
+    thread's other documents are left as they are. Pages are split as they
+    are parsed; every ``INGEST_EMBED_GROUP`` chunks are embedded in the
+    background while parsing continues, and each finished group is appended
+    to the document's FAISS index in order. Events look like ``{"stage",
+    "pages_parsed", "pages_total", "chunks_total", "chunks_embedded",
+    "progress", "eta_seconds"}``; the last one has ``stage == "done"`` and
+    carries the ingest ``summary``. Setting ``cancel`` stops the pipeline
+    with ``IngestJobCancelled`` before anything is published.
+    """
+    import faiss
+
+    if not file_bytes:
+        raise ValueError("No bytes received for ingestion.")
+
+    source = filename or "document.pdf"
+    doc_id = hashlib.sha256(file_bytes).hexdigest()[:16]
+    indexes = _lazy("index_store")
+    for info in indexes.metadata(str(thread_id)).get("files", []):
+        if info["doc_id"] == doc_id:
+            # Same bytes already in this thread's knowledge base
+            yield {"stage": "done", "progress": 1.0, "summary": {**info, "already_indexed": True}}
+            return
+    if indexes.has_document(doc_id):
+        # Another thread already indexed these exact bytes: just reference its index
+        indexes.attach(str(thread_id), doc_id, source)
+        invalidate_retrieval_cache(thread_id)
+        _sync_thread_registry(thread_id)
+        info = indexes.document_info(doc_id)
+        yield {
+            "stage": "done",
+            "progress": 1.0,
+            "summary": {"doc_id": doc_id, **info, "filename": source, "shared": True},
+        }
+        return
+    splitter = _make_splitter()
+    started = time.perf_counter()
+    # Seconds per stage, summed over the overlapped pipeline; exported as spans at the end
+    timings = dict.fromkeys(("parse", "split", "embed_wait", "faiss_add"), 0.0)
+    chunks = _ChunkStoreBuilder(source, doc_id)
+    group: List[str] = []  # texts waiting to be embedded; the only per-chunk strings held
+    pending: deque = deque()  # (size, future) in document order
+    cache_hits = 0
+    state = {"pages_parsed": 0, "pages_total": 0, "chunks_embedded": 0}
+    index = None
+
+    def _event(stage: str) -> dict:
+        parsed, total = state["pages_parsed"], state["pages_total"]
+        embedded = state["chunks_embedded"]
+        # Extrapolate the final chunk count from the pages seen so far
+        expected = len(chunks) * total / parsed if parsed else 0
+        expected = max(expected, len(chunks), 1)
+        done_frac = 0.2 * (parsed / total if total else 0) + 0.8 * (embedded / expected)
+        elapsed = time.perf_counter() - started
+        eta = elapsed * (1 - done_frac) / done_frac if done_frac > 0 else None
+        return {
+            "stage": stage,
+            "pages_parsed": parsed,
+            "pages_total": total,
+            "chunks_total": len(chunks),
+            "chunks_embedded": embedded,
+            "progress": min(1.0, done_frac),
+            "elapsed_seconds": elapsed,
+            "eta_seconds": eta,
+        }
+
+    def _drain(block: bool) -> bool:
+        """Append finished embedding groups to FAISS, in order. Returns True if any."""
+        nonlocal index, cache_hits
+        drained = False
+        while pending and (block or pending[0][1].done()):
+            size, future = pending[0]
+            tick = time.perf_counter()
+            while not wait([future], timeout=0.1).done:
+                _check_cancel()
+            pending.popleft()
+            vectors, stats = future.result()
+            timings["embed_wait"] += time.perf_counter() - tick
+            cache_hits += stats["hits"]
+            tick = time.perf_counter()
+            matrix = np.asarray(vectors, dtype=np.float32)
+            if index is None:
+                index = faiss.IndexFlatL2(matrix.shape[1])
+            index.add(matrix)  # row i is chunk i: groups are drained in document order
+            timings["faiss_add"] += time.perf_counter() - tick
+            state["chunks_embedded"] += size
+            drained = True
+            if block:
+                break
+        return drained
+
+    def _check_cancel() -> None:
+        if cancel is not None and cancel.is_set():
+            raise IngestJobCancelled()
+
+    def _embed_group(group: List[str]) -> tuple[List[List[float]], dict]:
+        stats: dict = {}
+        with span("ingest.embed_group"):
+            return _embed_with_retry(group, stats=stats), stats
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    pages = _timed(_iter_pdf_pages(file_bytes, source), timings, "parse")
+    try:
+        for total, page_doc in pages:
+            state["pages_total"] = total
+            state["pages_parsed"] += 1
+            tick = time.perf_counter()
+            page = page_doc.metadata["page"]
+            chunks.add_page(page, page_doc.metadata["page_label"], total)
+            for text in splitter.split_text(page_doc.page_content):
+                chunks.add(text, page)
+                group.append(text)
+            timings["split"] += time.perf_counter() - tick
+            if len(group) >= INGEST_EMBED_GROUP:
+                pending.append((len(group), pool.submit(_embed_group, group)))
+                group = []
+            _drain(block=False)
+            yield _event("parsing")
+            _check_cancel()  # before waiting on the next page
+
+        if group:
+            pending.append((len(group), pool.submit(_embed_group, group)))
+            group = []
+        while pending:
+            _drain(block=True)
+            yield _event("embedding")
+    finally:
+        # Closed early (job cancelled) or failed: stop page extraction, drop
+        # queued groups and don't wait for requests already in flight
+        pages.close()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if index is None:
+        raise ValueError("No extractable text found in the PDF.")
+
+    _check_cancel()
+    yield _event("indexing")
+    # Vectors were appended to a flat index as they arrived; large documents are
+    # rebuilt (and trained, for IVF-PQ) into a graph or compressed index.
+    index_type = choose_faiss_index_type(len(chunks))
+    if index_type != "flat":
+        with span("ingest.faiss_build"):
+            index = build_faiss_index(index.reconstruct_n(0, index.ntotal), index_type)
+    # FAISS row ids and BM25 doc ids are both chunk ids into the one chunk store
+    store = chunks.build()
+    with span("ingest.bm25_build"):
+        bm25_index = _BM25Index.from_texts(store)
+
+    info = {
+        "filename": source,
+        "pages": state["pages_parsed"],
+        "chunks": len(store),
+        "index_type": faiss_index_type(index),
+    }
+    with span("ingest.publish"):
+        segment = {"faiss": index, "bm25": bm25_index, "chunks": store}
+        indexes.publish_document(doc_id, segment, info)
+    indexes.attach(str(thread_id), doc_id, source)
+    invalidate_retrieval_cache(thread_id)
+    _sync_thread_registry(thread_id)
+
+    for stage, seconds in timings.items():
+        observe(f"ingest.{stage}", seconds)
+    event = _event("done")
+    observe("ingest.total", event["elapsed_seconds"])
+    event["summary"] = {
+        "doc_id": doc_id,
+        **info,
+        "embedding_cache_hit_rate": cache_hits / len(store),
+        "seconds": event["elapsed_seconds"],
+    }
+    yield event
+
+
+def ingest_pdf(file_bytes: bytes, thread_id: str, filename: Optional[str] = None) -> dict:
+    """
+    Add the uploaded PDF to the thread's knowledge base.
+
+    Returns a summary dict that can be surfaced in the UI.
+    """
+    summary: dict = {}
+    for event in ingest_pdf_stream(file_bytes, thread_id, filename):
+        if event["stage"] == "done":
+            summary = event["summary"]
+    return summary
+
+
+# -------------------
+# 2c. Ingestion jobs  (background worker pool shared by all sessions)
+# -------------------
+# At most this many PDFs are ingested at once, across every browser session
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Jobs waiting or running beyond this are refused instead of queued
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "16"))
+# Finished jobs stay visible to status polling for this long
+INGEST_JOB_TTL = float(os.getenv("INGEST_JOB_TTL", "3600"))
+
+JOB_ACTIVE_STATES = ("queued", "parsing", "embedding", "indexing")
+JOB_FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class _IngestJob:
+    def __init__(self, file_bytes: bytes, thread_id: str, filename: str):
+        self.id = uuid.uuid4().hex
+        self.thread_id = thread_id
+        self.filename = filename
+        self.doc_id = hashlib.sha256(file_bytes).hexdigest()[:16]
+        self.file_bytes: Optional[bytes] = file_bytes  # dropped once the job starts
+        self.state = "queued"
+        self.event: dict = {}
+        self.summary: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    def snapshot(self) -> dict:
+        event = self.event
+        return {
+            "job_id": self.id,
+            "thread_id": self.thread_id,
+            "filename": self.filename,
+            "doc_id": self.doc_id,
+            "state": self.state,
+            "progress": 1.0 if self.state == "done" else event.get("progress", 0.0),
+            "pages_parsed": event.get("pages_parsed", 0),
+            "pages_total": event.get("pages_total", 0),
+            "chunks_total": event.get("chunks_total", 0),
+            "chunks_embedded": event.get("chunks_embedded", 0),
+            "eta_seconds": event.get("eta_seconds"),
+            "summary": self.summary,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class _IngestJobQueue:
+    """
+    Runs ``ingest_pdf_stream`` on a bounded worker pool.
+
+    Each job moves through queued -> parsing -> embedding -> indexing ->
+    done, or ends as failed / cancelled. The pipeline checks for
+    cancellation while parsing and while waiting on embeddings, so nothing
+    is published for a cancelled job; a queued job is dropped before it
+    starts. A job already building its index finishes as done.
+    """
+
+    def __init__(self, workers: int, max_jobs: int, ttl: float):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest")
+        self.workers = max(1, workers)
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.jobs: "OrderedDict[str, _IngestJob]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(("submitted", "rejected", *JOB_FINAL_STATES), 0)
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def submit(self, file_bytes: bytes, thread_id: str, filename: Optional[str] = None) -> str:
+        """Queue a PDF for ingestion and return its job id."""
+        if not file_bytes:
+            raise ValueError("No bytes received for ingestion.")
+        job = _IngestJob(file_bytes, str(thread_id), filename or "document.pdf")
+        with self.lock:
+            self._expire()
+            for other in self.jobs.values():
+                # The same PDF already on its way into this thread: reuse that job
+                if (
+                    other.thread_id == job.thread_id
+                    and other.doc_id == job.doc_id
+                    and other.state in JOB_ACTIVE_STATES
+                ):
+                    return other.id
+            if sum(j.state in JOB_ACTIVE_STATES for j in self.jobs.values()) >= self.max_jobs:
+                self.counters["rejected"] += 1
+                raise RuntimeError("Ingestion queue is full; try again in a moment.")
+            self.jobs[job.id] = job
+            self.counters["submitted"] += 1
+            job.future = self.pool.submit(self._run, job)
+        return job.id
+
+    def _finish(self, job: _IngestJob, state: str, error: Optional[str] = None) -> None:
+        with self.lock:
+            job.state = state
+            job.error = error
+            job.finished = time.time()
+            job.file_bytes = None
+            self.counters[state] += 1
+
+    def _run(self, job: _IngestJob) -> None:
+        if job.cancel_requested.is_set():
+            self._finish(job, "cancelled")
+            return
+        with self.lock:
+            file_bytes, job.file_bytes = job.file_bytes, None
+            job.started = time.time()
+            job.state = "parsing"
+        observe("ingest.queue_wait", job.started - job.created)
+        try:
+            for event in ingest_pdf_stream(
+                file_bytes, job.thread_id, job.filename, cancel=job.cancel_requested
+            ):
+                job.event = event
+                if event["stage"] == "done":
+                    job.summary = event.get("summary")
+                else:
+                    job.state = event["stage"]
+        except IngestJobCancelled:
+            self._finish(job, "cancelled")
+            return
+        except Exception as e:
+            self._finish(job, "failed", str(e) or type(e).__name__)
+            return
+        self._finish(job, "done")
+
+    def cancel(self, job_id: str) -> bool:
+        """Ask a queued or running job to stop. Returns False if it already ended."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in JOB_ACTIVE_STATES:
+                return False
+            job.cancel_requested.set()
+            if job.state == "queued" and job.future.cancel():
+                job.state = "cancelled"
+                job.finished = time.time()
+                job.file_bytes = None
+                self.counters["cancelled"] += 1
+        return True
+
+    def status(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.snapshot() if job else None
+
+    def for_thread(self, thread_id: str) -> List[dict]:
+        """The thread's jobs, oldest first (finished ones until they expire)."""
+        with self.lock:
+            self._expire()
+            return [j.snapshot() for j in self.jobs.values() if j.thread_id == str(thread_id)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            states = [j.state for j in self.jobs.values()]
+            return {
+                "workers": self.workers,
+                "max_jobs": self.max_jobs,
+                "queued": states.count("queued"),
+                "running": sum(s in JOB_ACTIVE_STATES[1:] for s in states),
+                **self.counters,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def _load_ingest_jobs():
+    return _IngestJobQueue(INGEST_WORKERS, INGEST_QUEUE_MAX, INGEST_JOB_TTL)
+
+ingest_jobs = _load_ingest_jobs()
+
+
+def submit_ingest_job(file_bytes: bytes, thread_id: str, filename: Optional[str] = None) -> str:
+    """Ingest a PDF in the background; poll with ``ingest_job_status``."""
+    return ingest_jobs.submit(file_bytes, thread_id, filename)
+
+
+def ingest_job_status(job_id: str) -> Optional[dict]:
+    return ingest_jobs.status(job_id)
+
+
+def thread_ingest_jobs(thread_id: str) -> List[dict]:
+    return ingest_jobs.for_thread(thread_id)
+
+
+def cancel_ingest_job(job_id: str) -> bool:
+    return ingest_jobs.cancel(job_id)
+
+
+def ingest_job_stats() -> dict:
+    """Worker count, queue depth and per-outcome job counters."""
+    return ingest_jobs.stats()
+
+
+# -------------------
+# 3. Hybrid retrieval  (FAISS + BM25 in parallel, fused by rank)
+# -------------------
+RETRIEVAL_DEFAULTS = {
+    "faiss_k": 6,
+    "bm25_k": 6,
+    "fusion": "rrf",  # "rrf" (reciprocal rank) or "weighted" (min-max normalised scores)
+    "rrf_k": 60,
+    "weights": {"faiss": 1.0, "bm25": 1.0},
+    "top_n": 8,
+}
+
+_RETRIEVAL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+
+def retrieval_config(thread_id: str) -> dict:
+    """Effective retrieval settings for a thread (defaults + stored overrides)."""
+    overrides = _lazy("index_store").metadata(str(thread_id)).get("retrieval", {})
+    config = {**RETRIEVAL_DEFAULTS, **overrides}
+    config["weights"] = {**RETRIEVAL_DEFAULTS["weights"], **overrides.get("weights", {})}
+    return config
+
+
+def _check_retrieval_overrides(overrides: dict) -> dict:
+    """Validate (and normalise) overrides before they are persisted and used on every query."""
+    unknown = set(overrides) - set(RETRIEVAL_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown retrieval settings: {sorted(unknown)}")
+    checked = dict(overrides)
+    for key in ("faiss_k", "bm25_k", "rrf_k", "top_n"):
+        value = checked.get(key)
+        if key in checked and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+            raise ValueError(f"{key} must be a positive integer, got {value!r}")
+    if "fusion" in checked and checked["fusion"] not in ("rrf", "weighted"):
+        raise ValueError(f"fusion must be 'rrf' or 'weighted', got {checked['fusion']!r}")
+    if "weights" in checked:
+        weights = checked["weights"]
+        if not isinstance(weights, dict) or set(weights) - set(RETRIEVAL_DEFAULTS["weights"]):
+            raise ValueError(f"weights must map 'faiss'/'bm25' to numbers, got {weights!r}")
+        for name, value in weights.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError(f"weights[{name!r}] must be a number, got {value!r}")
+        checked["weights"] = {name: float(value) for name, value in weights.items()}
+    return checked
+
+
+def set_retrieval_config(thread_id: str, **overrides) -> dict:
+    """Persist per-thread overrides of RETRIEVAL_DEFAULTS (k, fusion, weights, top_n)."""
+    overrides = _check_retrieval_overrides(overrides)
+    store = _lazy("index_store")
+    if not store.contains(str(thread_id)):
+        raise ValueError("No document indexed for this chat.")
+    stored = store.metadata(str(thread_id)).get("retrieval", {})
+    store.update_metadata(str(thread_id), retrieval={**stored, **overrides})
+    return retrieval_config(thread_id)
+
+
+# Two-level query cache: repeated questions skip the embedding request and the search
+class _TTLCache:
+    """Thread-safe LRU mapping whose entries also expire after ``ttl`` seconds."""
 
-from dotenv import load_dotenv
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import FAISS
-from langchain_community.retrievers import BM25Retriever
-from langchain_core.messages import BaseMessage, SystemMessage
-from langchain_core.tools import tool
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_huggingface import HuggingFaceEndpointEmbeddings
-from langgraph.checkpoint.sqlite import SqliteSaver  # requires: pip install langgraph-checkpoint-sqlite
-from langgraph.graph import START, StateGraph
-from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple[float, Any]]" = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
 
+    def get(self, key: tuple) -> Any:
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
 
-load_dotenv()
+    def put(self, key: tuple, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
 
-# langchain_google_genai needs GOOGLE_API_KEY; support GEMINI_API_KEY as alias
-if not os.getenv("GOOGLE_API_KEY") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.environ["GEMINI_API_KEY"]
+    def invalidate(self, prefix: tuple) -> int:
+        """Drop every entry whose key starts with ``prefix``."""
+        with self.lock:
+            stale = [k for k in self._entries if k[: len(prefix)] == prefix]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
 
-# -------------------
-# 1. LLM + embeddings  (cached so they're built only ONCE per server lifetime)
-# -------------------
-@st.cache_resource(show_spinner=False)
-def _load_llm():
-    return ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
 
-@st.cache_resource(show_spinner=False)
-def _load_embeddings():
-    return HuggingFaceEndpointEmbeddings(
-        huggingfacehub_api_token=os.environ.get("HF_TOKEN"),
-        model="sentence-transformers/all-MiniLM-L6-v2"
-    )
 
-llm = _load_llm()
-embeddings = _load_embeddings()
+# Level 1: normalized query text -> query embedding (skips the embedding request)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+# Level 2: (thread, index version, query, retrieval settings) -> fused results
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
 
-# -------------------
-# 2. PDF retriever store (per thread)
-# -------------------
-_THREAD_RETRIEVERS: Dict[str, Any] = {}
-_THREAD_METADATA: Dict[str, dict] = {}
+query_embedding_cache = _TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+retrieval_cache = _TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
 
 
-def _get_retriever(thread_id: Optional[str]):
-    """Fetch the retriever for a thread if available."""
-    if thread_id and thread_id in _THREAD_RETRIEVERS:
-        return _THREAD_RETRIEVERS[thread_id]
-    return None
+def _normalize_query(query: str) -> str:
+    # The embedding model is uncased and BM25 lowercases, so case and spacing don't matter
+    return " ".join(query.casefold().split())
 
 
-def _embed_with_retry(texts: List[str], batch_size: int = 50, max_retries: int = 5) -> List[List[float]]:
-    """Embed text in batches with exponential backoff on 429 rate-limit errors."""
-    all_embeddings: List[List[float]] = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i : i + batch_size]
-        wait = 2
-        for attempt in range(max_retries):
-            try:
-                all_embeddings.extend(embeddings.embed_documents(batch))
-                break
-            except Exception as e:
-                # Inference API might return 503 while loading or 429 for rate limit. Try backing off.
-                if attempt < max_retries - 1:
-                    time.sleep(wait)
-                    wait *= 2  # exponential backoff
-                else:
-                    raise
-        # Small pause between batches to avoid burst rate limit
-        if i + batch_size < len(texts):
-            time.sleep(1)
-    return all_embeddings
+def _retry_throttled(call, max_retries: int = 3):
+    """``call()`` with a short backoff on 429/503, for small interactive requests."""
+    for attempt in range(max_retries + 1):
+        try:
+            return call()
+        except Exception as e:
+            status, retry_after = _throttle_info(e)
+            if status not in (429, 503) or attempt == max_retries:
+                raise
+            time.sleep(retry_after if retry_after is not None else 0.5 * 2**attempt)
 
 
-def ingest_pdf(file_bytes: bytes, thread_id: str, filename: Optional[str] = None) -> dict:
+def _embed_query(query: str, max_retries: int = 3) -> List[float]:
+    key = (EMBEDDING_MODEL_ID, _normalize_query(query))
+    vector = query_embedding_cache.get(key)
+    if vector is None:
+        vector = _retry_throttled(lambda: _lazy("embeddings").embed_query(key[1]), max_retries)
+        query_embedding_cache.put(key, vector)
+    return vector
+
+
+def invalidate_retrieval_cache(thread_id: str) -> int:
+    """Forget cached results for a thread (its knowledge base or settings changed)."""
+    return retrieval_cache.invalidate((str(thread_id),))
+
+
+def query_cache_stats() -> dict:
+    return {"embeddings": query_embedding_cache.stats(), "results": retrieval_cache.stats()}
+
+
+def _chunk_key(doc: Document) -> str:
+    return f"{doc.metadata.get('doc_id', '')}:{doc.metadata.get('chunk_id', '')}"
+
+
+def _faiss_search(segments: Dict[str, dict], query: str, k: int) -> tuple[list, float, list]:
     """
-    Build a FAISS retriever for the uploaded PDF and store it for the thread.
+    Top-k ``(doc_id, chunk_id, distance)`` across all of a thread's documents
+    (plus the query vector).
+    """
+    started = time.perf_counter()
+    with span("retrieval.query_embed"):
+        query_vector = _embed_query(query)  # once, shared by every segment
+    vector = np.asarray([query_vector], dtype=np.float32)
+    hits = []
+    for doc_id, segment in segments.items():
+        distances, ids = segment["faiss"].search(vector, k)
+        hits.extend((doc_id, int(i), float(d)) for i, d in zip(ids[0], distances[0]) if i >= 0)
+    hits.sort(key=lambda hit: hit[2])  # exact L2 distances are comparable across segments
+    return hits[:k], time.perf_counter() - started, query_vector
 
-    Returns a summary dict that can be surfaced in the UI.
+
+def _bm25_search(segments: Dict[str, dict], query: str, k: int) -> tuple[list, float]:
+    """Top-k ``(doc_id, chunk_id, score)`` by BM25 across all documents, using collection-wide idf/avgdl."""
+    started = time.perf_counter()
+    indexes = [segment["bm25"] for segment in segments.values()]
+    n_docs = sum(len(index) for index in indexes)
+    avgdl = sum(index.total_len for index in indexes) / max(n_docs, 1)
+    terms = {t for index in indexes for t in index.query_terms(query)}
+    df = {t: sum(index.doc_freq(t) for index in indexes) for t in terms}
+    hits = []
+    for doc_id, segment in segments.items():
+        ids, scores = segment["bm25"].top_k(query, k, stats=(n_docs, avgdl, df))
+        hits.extend((doc_id, int(i), float(score)) for i, score in zip(ids, scores))
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits[:k], time.perf_counter() - started
+
+
+def _fuse(segments: Dict[str, dict], faiss_hits: list, bm25_hits: list, config: dict) -> list[dict]:
     """
-    if not file_bytes:
-        raise ValueError("No bytes received for ingestion.")
+    Merge both ranked lists into one, deduplicated on (doc_id, chunk_id).
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(file_bytes)
-        temp_path = temp_file.name
+    Only the fused top_n chunks are turned into ``Document`` objects.
+    """
+    fused: Dict[Any, dict] = {}
+    weights = config["weights"]
 
-    try:
-        loader = PyPDFLoader(temp_path)
-        docs = loader.load()
+    def _minmax(values: List[float], invert: bool) -> List[float]:
+        lo, hi = min(values), max(values)
+        span = (hi - lo) or 1.0
+        return [((hi - v) if invert else (v - lo)) / span for v in values]
 
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1500, chunk_overlap=150, separators=["\n\n", "\n", " ", ""]
-        )
-        chunks = splitter.split_documents(docs)
-        texts = [c.page_content for c in chunks]
-        metadatas = [c.metadata for c in chunks]
+    for name, hits, invert in (("faiss", faiss_hits, True), ("bm25", bm25_hits, False)):
+        if not hits:
+            continue
+        # FAISS returns L2 distances (lower is better), BM25 raw scores (higher is better)
+        normalised = _minmax([score for _, _, score in hits], invert)
+        for rank, ((doc_id, chunk_id, raw), norm) in enumerate(zip(hits, normalised), start=1):
+            entry = fused.setdefault((doc_id, chunk_id), {"score": 0.0})
+            entry[f"{name}_rank"] = rank
+            entry["faiss_distance" if name == "faiss" else "bm25_score"] = float(raw)
+            if config["fusion"] == "weighted":
+                entry["score"] += weights[name] * norm
+            else:
+                entry["score"] += weights[name] / (config["rrf_k"] + rank)
+    top = sorted(fused.items(), key=lambda item: item[1]["score"], reverse=True)[: config["top_n"]]
+    return [
+        {"doc": segments[doc_id]["chunks"].document(chunk_id), **entry}
+        for (doc_id, chunk_id), entry in top
+    ]
 
-        # Embed with retry/backoff to handle free-tier 429 rate limits
-        chunk_embeddings = _embed_with_retry(texts)
 
-        vector_store = FAISS.from_embeddings(
-            text_embeddings=list(zip(texts, chunk_embeddings)),
-            embedding=embeddings,
-            metadatas=metadatas,
-        )
-        faiss_retriever = vector_store.as_retriever(
-            search_type="similarity", search_kwargs={"k": 6}
-        )
-        
-        bm25_retriever = BM25Retriever.from_texts(texts, metadatas=metadatas)
-        bm25_retriever.k = 6
+def hybrid_search(
+    thread_id: Optional[str], query: str, document: Optional[str] = None
+) -> Optional[dict]:
+    """
+    Run FAISS and BM25 concurrently and fuse them. None if nothing is indexed.
 
-        _THREAD_RETRIEVERS[str(thread_id)] = {
-            "faiss": faiss_retriever,
-            "bm25": bm25_retriever
-        }
-        _THREAD_METADATA[str(thread_id)] = {
-            "filename": filename or os.path.basename(temp_path),
-            "documents": len(docs),
-            "chunks": len(chunks),
-        }
+    ``document`` (doc_id or filename) limits the search to one document.
+    """
+    started = time.perf_counter()
+    metadata = _lazy("index_store").metadata(str(thread_id)) if thread_id else {}
+    config = retrieval_config(str(thread_id))
+    # Any index change bumps the version (and changes the doc set), so stale keys never match
+    cache_key = (
+        str(thread_id),
+        metadata.get("version", 0),
+        tuple(f["doc_id"] for f in metadata.get("files", [])),
+        document,
+        _normalize_query(query),
+        json.dumps(config, sort_keys=True),
+    )
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        observe("retrieval.hybrid_cached", time.perf_counter() - started)
+        elapsed = round((time.perf_counter() - started) * 1000, 2)
+        return {**cached, "cached": True, "timings_ms": {"faiss": 0.0, "bm25": 0.0, "total": elapsed}}
 
-        return {
-            "filename": filename or os.path.basename(temp_path),
-            "documents": len(docs),
-            "chunks": len(chunks),
-        }
-    finally:
-        try:
-            os.remove(temp_path)
-        except OSError:
-            pass
+    segments = _get_retriever(thread_id, document)
+    if segments is None:
+        return None
+    faiss_future = _RETRIEVAL_POOL.submit(_faiss_search, segments, query, config["faiss_k"])
+    bm25_future = _RETRIEVAL_POOL.submit(_bm25_search, segments, query, config["bm25_k"])
+    faiss_hits, faiss_seconds, query_vector = faiss_future.result()
+    bm25_hits, bm25_seconds = bm25_future.result()
+    results = _fuse(segments, faiss_hits, bm25_hits, config)
+    observe("retrieval.faiss", faiss_seconds)
+    observe("retrieval.bm25", bm25_seconds)
+    observe("retrieval.hybrid", time.perf_counter() - started)
+    search = {
+        "results": results,
+        "query_vector": query_vector,
+        "fusion": config["fusion"],
+        "cached": False,
+        "timings_ms": {
+            "faiss": round(faiss_seconds * 1000, 2),
+            "bm25": round(bm25_seconds * 1000, 2),
+            "total": round((time.perf_counter() - started) * 1000, 2),
+        },
+    }
+    retrieval_cache.put(cache_key, search)
+    return search
 
 
 # -------------------
-# 3. Tools
+# 3b. Context packing  (token budget + extractive compression of retrieved chunks)
 # -------------------
+# Estimated tokens of excerpts handed to the LLM per retrieval
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Keep only the sentences closest to the query. Every retrieval then embeds its
+# sentences, so it is on by default only when embeddings are local (no quota)
+CONTEXT_COMPRESSION = (
+    os.getenv("CONTEXT_COMPRESSION", "1" if EMBEDDING_BACKEND == "local" else "0") == "1"
+)
+CONTEXT_MAX_SENTENCES = int(os.getenv("CONTEXT_MAX_SENTENCES", "5"))  # per passage
+# Sentence vectors stay in memory: they would evict chunk vectors from embedding_cache
+SENTENCE_CACHE_SIZE = int(os.getenv("SENTENCE_CACHE_SIZE", "4096"))
+
+sentence_embedding_cache = _TTLCache(SENTENCE_CACHE_SIZE, QUERY_CACHE_TTL)
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+_packing_counters = {"calls": 0, "tokens_in": 0, "tokens_out": 0}
+_PACKING_LOCK = threading.Lock()
 
 
+def _text_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token)."""
+    return len(text) // 4
 
 
-@tool
-def rag_tool(query: str, thread_id: Optional[str] = None) -> dict:
+def _sentences(text: str, max_chars: int = 600) -> List[str]:
+    """Sentence-ish units; overlong ones (tables, unpunctuated text) are split on lines."""
+    units = []
+    for sentence in _SENTENCE_RE.split(text):
+        pieces = sentence.split("\n") if len(sentence) > max_chars else [sentence]
+        units.extend(p.strip() for p in pieces if p.strip())
+    return units
+
+
+def _embed_sentences(sentences: List[str]) -> List[List[float]]:
     """
-    Retrieve relevant information from the uploaded PDF for this chat thread.
-    Always include the thread_id when calling this tool.
+    Sentence vectors for compression: cached in memory, and the misses sent in
+    one direct request (not through the ingest scheduler's rate limiter).
     """
-    retrievers = _get_retriever(thread_id)
-    if retrievers is None:
-        return {
-            "error": "No document indexed for this chat. Upload a PDF first.",
-            "query": query,
-        }
+    keys = [(EMBEDDING_MODEL_ID, s) for s in sentences]
+    vectors = {}
+    for key in keys:
+        cached = sentence_embedding_cache.get(key)
+        if cached is not None:
+            vectors[key] = cached
+    misses = list(dict.fromkeys(k for k in keys if k not in vectors))
+    if misses:
+        client = _lazy("embeddings")
+        embedded = _retry_throttled(lambda: client.embed_documents([k[1] for k in misses]))
+        for key, vector in zip(misses, embedded):
+            sentence_embedding_cache.put(key, vector)
+            vectors[key] = vector
+    return [vectors[k] for k in keys]
+
+
+def _merge_overlap(left: str, right: str, max_overlap: int = 300) -> Optional[str]:
+    """Join two consecutive chunks on their shared overlap, or None if they don't overlap."""
+    for size in range(min(len(left), len(right), max_overlap), 19, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return None
 
-    # Query both retrievers
-    faiss_docs = retrievers["faiss"].invoke(query)
-    bm25_docs = retrievers["bm25"].invoke(query)
 
-    # Combine and deduplicate based on content
-    all_docs = []
-    seen = set()
-    for doc in (bm25_docs + faiss_docs):
-        if doc.page_content not in seen:
-            all_docs.append(doc)
-            seen.add(doc.page_content)
-            
-    # Take top 8 combined results
-    all_docs = all_docs[:8]
+def _merge_adjacent(results: List[dict]) -> List[dict]:
+    """Fold consecutive chunks of the same page into one passage, best score first."""
+    def _position(r):
+        meta = r["doc"].metadata
+        return meta.get("doc_id", ""), meta.get("chunk_id", -1)
 
-    context = [doc.page_content for doc in all_docs]
-    metadata = [doc.metadata for doc in all_docs]
+    passages: List[dict] = []
+    for r in sorted(results, key=_position):
+        meta = r["doc"].metadata
+        if passages:
+            last = passages[-1]
+            prev = last["docs"][-1].metadata
+            if (
+                prev.get("doc_id") == meta.get("doc_id")
+                and prev.get("page") == meta.get("page")
+                and meta.get("chunk_id") == prev.get("chunk_id", -2) + 1
+            ):
+                merged = _merge_overlap(last["text"], r["doc"].page_content)
+                if merged is not None:
+                    last["text"] = merged
+                    last["docs"].append(r["doc"])
+                    last["score"] = max(last["score"], r["score"])
+                    continue
+        passages.append({"docs": [r["doc"]], "text": r["doc"].page_content, "score": r["score"]})
+    passages.sort(key=lambda p: p["score"], reverse=True)
+    return passages
 
+
+def pack_context(
+    results: List[dict],
+    query_vector: Optional[List[float]],
+    budget: Optional[int] = None,
+    compress: Optional[bool] = None,
+) -> tuple[List[dict], dict]:
+    """
+    Fit fused results into ``budget`` tokens in score order.
+
+    Overlapping neighbours are merged first; with compression each passage is
+    cut down to its CONTEXT_MAX_SENTENCES sentences most similar to the query.
+    Returns the packed passages ({"docs", "text", "score"}) and token counts.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    compress = CONTEXT_COMPRESSION if compress is None else compress
+    passages = _merge_adjacent(results)
+    tokens_in = sum(_text_tokens(r["doc"].page_content) for r in results)
+
+    # (sentence, similarity) per passage; a single unit when not compressing
+    units = [[(p["text"], 0.0)] for p in passages]
+    if compress and query_vector is not None and passages:
+        split = [_sentences(p["text"]) for p in passages]
+        flat = [s for sentences in split for s in sentences]
+        if flat:
+            vectors = np.asarray(_embed_sentences(flat), dtype=np.float32)
+            query = np.asarray(query_vector, dtype=np.float32)
+            sims = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+            offset = 0
+            for i, sentences in enumerate(split):
+                units[i] = list(zip(sentences, sims[offset : offset + len(sentences)].tolist()))
+                offset += len(sentences)
+
+    packed, used = [], 0
+    for passage, sentences in zip(passages, units):
+        # Best sentences first while they fit, then restore reading order
+        ranked = sorted(range(len(sentences)), key=lambda i: sentences[i][1], reverse=True)
+        keep = []
+        for i in ranked[:CONTEXT_MAX_SENTENCES] if compress else ranked:
+            cost = _text_tokens(sentences[i][0]) + 1
+            if used + cost <= budget:
+                keep.append(i)
+                used += cost
+        if not keep:
+            continue
+        keep.sort()
+        parts = [sentences[keep[0]][0]]
+        for prev, i in zip(keep, keep[1:]):
+            parts.append((" " if i == prev + 1 else " … ") + sentences[i][0])
+        packed.append({**passage, "text": "".join(parts)})
+        if budget - used < 16:
+            break
+
+    tokens_out = sum(_text_tokens(p["text"]) for p in packed)
+    with _PACKING_LOCK:
+        _packing_counters["calls"] += 1
+        _packing_counters["tokens_in"] += tokens_in
+        _packing_counters["tokens_out"] += tokens_out
+    return packed, {"tokens": tokens_out, "tokens_saved": max(tokens_in - tokens_out, 0)}
+
+
+def context_packing_stats() -> dict:
+    """Tokens retrieved vs. tokens actually sent, over all packed retrievals."""
+    with _PACKING_LOCK:
+        counters = dict(_packing_counters)
+    counters["tokens_saved"] = counters["tokens_in"] - counters["tokens_out"]
+    counters["saved_ratio"] = (
+        counters["tokens_saved"] / counters["tokens_in"] if counters["tokens_in"] else 0.0
+    )
+    counters["compression"] = CONTEXT_COMPRESSION
+    counters["sentence_cache"] = sentence_embedding_cache.stats()
+    return counters
+
+
+# -------------------
+# 4. Tools
+# -------------------
+def _rag_tool_entry(query: str, thread_id: Optional[str] = None, document: Optional[str] = None) -> dict:
+    """
+    Retrieve relevant information from the uploaded PDFs for this chat thread.
+    Always include the thread_id when calling this tool. Pass `document` (a
+    filename) only to restrict the search to one of the uploaded PDFs.
+    """
+    with span("rag_tool"):
+        return _rag_tool(query, thread_id, document)
+
+
+def _rag_tool(query: str, thread_id: Optional[str], document: Optional[str]) -> dict:
+    search = hybrid_search(thread_id, query, document)
+    if search is None:
+        return {
+            "error": (
+                f"No indexed document named {document!r} in this chat."
+                if document and _lazy("index_store").contains(str(thread_id))
+                else "No document indexed for this chat. Upload a PDF first."
+            ),
+            "query": query,
+        }
+
+    results = search["results"]
+    with span("retrieval.pack"):
+        packed, packing = pack_context(results, search["query_vector"])
+    # Shared indexes carry the first uploader's filename; report this thread's names
+    names = {f["doc_id"]: f["filename"] for f in _thread_files(thread_id)}
+    metadata = []
+    for passage in packed:
+        meta = passage["docs"][0].metadata
+        metadata.append(
+            {
+                **meta,
+                "source": names.get(meta.get("doc_id"), meta.get("source")),
+                "chunk_ids": [_chunk_key(doc) for doc in passage["docs"]],
+            }
+        )
     return {
         "query": query,
-        "context": context,
+        "context": [passage["text"] for passage in packed],
         "metadata": metadata,
-        "source_file": _THREAD_METADATA.get(str(thread_id), {}).get("filename"),
+        "context_tokens": packing["tokens"],
+        "tokens_saved": packing["tokens_saved"],
+        "scores": [
+            {"chunk_id": _chunk_key(r["doc"]), **{k: v for k, v in r.items() if k != "doc"}}
+            for r in results
+        ],
+        "fusion": search["fusion"],
+        "timings_ms": search["timings_ms"],
+        "source_files": sorted({m["source"] for m in metadata}),
     }
 
 
-tools = [rag_tool]
-llm_with_tools = llm.bind_tools(tools)
+def _build_tools() -> list:
+    from langchain_core.tools import tool
+
+    # The docstring of _rag_tool_entry is the description the model sees
+    return [tool("rag_tool")(_rag_tool_entry)]
 
 # -------------------
-# 4. State
+# 5. State
 # -------------------
 class ChatState(TypedDict):
     messages: Annotated[list[BaseMessage], add_messages]
+    # Pre-retrieval mode only: excerpts for the current turn (overwritten, not accumulated)
+    context: NotRequired[str]
+    # Running summary of turns dropped by compaction (HISTORY_COMPACTION=summarize)
+    summary: NotRequired[str]
 
 
 # -------------------
-# 5. Nodes
+# 6. Nodes
 # -------------------
+# "agent": LLM decides whether to call rag_tool (two LLM calls per document question)
+# "preretrieval": retrieve from the question up front, answer in a single streamed call
+CHAT_GRAPH_MODE = os.getenv("CHAT_GRAPH_MODE", "agent")
+# Below this cosine similarity (and with no content word shared with a retrieved
+# chunk) retrieved context is dropped
+PRERETRIEVAL_MIN_SIMILARITY = float(os.getenv("PRERETRIEVAL_MIN_SIMILARITY", "0.25"))
+# BM25 scores every shared token; these alone don't make a question on-topic
+_STOPWORDS = frozenset(
+    "a about am an and any are as at be been but by can could did do does for from had has "
+    "have how i if in into is it its me my no not of on or our so than that the their them "
+    "then there these they this to was we were what when where which who whom why will "
+    "with would you your".split()
+)
+
+_CHITCHAT_RE = re.compile(
+    r"^\s*(hi|hello|hey|yo|thanks|thank you|thx|ty|ok|okay|cool|great|nice|bye|goodbye|"
+    r"good (morning|afternoon|evening|night)|how are you|who are you|what can you do)"
+    r"\b[\s!.?,:)]*(there|again|so much|a lot)?[\s!.?,:)]*$",
+    re.IGNORECASE,
+)
+
+
+def _thread_id_from(config) -> Optional[str]:
+    if config and isinstance(config, dict):
+        return config.get("configurable", {}).get("thread_id")
+    return None
+
+
+def _last_question(state: ChatState) -> str:
+    from langchain_core.messages import HumanMessage
+
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            return message.content if isinstance(message.content, str) else str(message.content)
+    return ""
+
+
 def chat_node(state: ChatState, config=None):
     """LLM node that may answer or request a tool call."""
-    thread_id = None
-    if config and isinstance(config, dict):
-        thread_id = config.get("configurable", {}).get("thread_id")
+    from langchain_core.messages import SystemMessage
+
+    thread_id = _thread_id_from(config)
 
     system_message = SystemMessage(
         content=(
-            "You are a helpful assistant. For questions about the uploaded PDF, call "
+            "You are a helpful assistant. For questions about the uploaded PDFs, call "
             "the `rag_tool` and include the thread_id "
             f"`{thread_id}`. You can also use the web search, stock price, and "
             "calculator tools when helpful. If no document is available, ask the user "
             "to upload a PDF."
+            + _summary_note(state)
         )
     )
 
     messages = [system_message, *state["messages"]]
-    response = llm_with_tools.invoke(messages, config=config)
+    with span("llm.chat_node"):
+        response = _lazy("llm_with_tools").invoke(messages, config=config)
+    _record_prompt(thread_id, state, messages, response)
+    _remember_answer(state, response, config)
+    return {"messages": [response]}
+
+
+def should_retrieve(question: str, thread_id: Optional[str]) -> bool:
+    """Cheap router: skip retrieval for chit-chat or when nothing is indexed."""
+    if not thread_id or not _lazy("index_store").contains(str(thread_id)):
+        return False
+    return not _CHITCHAT_RE.match(question)
+
+
+def retrieve_node(state: ChatState, config=None):
+    """Pre-retrieval mode: fetch excerpts for the latest question, no LLM involved."""
+    thread_id = _thread_id_from(config)
+    question = _last_question(state)
+    if not should_retrieve(question, thread_id):
+        return {"context": ""}
+    search = hybrid_search(thread_id, question)
+    results = search["results"] if search else []
+    # Unit-length embeddings: squared L2 distance d maps to cosine 1 - d / 2
+    similarities = [1 - r["faiss_distance"] / 2 for r in results if "faiss_distance" in r]
+    terms = {t for t in _tokenize(question) if t not in _STOPWORDS}
+    lexical_match = bool(terms) and any(
+        "bm25_rank" in r and not terms.isdisjoint(_tokenize(r["doc"].page_content)) for r in results
+    )
+    if not lexical_match and max(similarities, default=0.0) < PRERETRIEVAL_MIN_SIMILARITY:
+        return {"context": ""}
+    with span("retrieval.pack"):
+        packed, _ = pack_context(results, search["query_vector"])
+    names = {f["doc_id"]: f["filename"] for f in _thread_files(thread_id)}
+    excerpts = []
+    for passage in packed:
+        meta = passage["docs"][0].metadata
+        source = names.get(meta.get("doc_id"), meta.get("source"))
+        excerpts.append(f"[{source}, page {meta.get('page_label', '?')}]\n{passage['text']}")
+    return {"context": "\n\n---\n\n".join(excerpts)}
+
+
+def answer_node(state: ChatState, config=None):
+    """Pre-retrieval mode: answer in one LLM call with the retrieved excerpts inlined."""
+    from langchain_core.messages import SystemMessage
+
+    context = state.get("context") or ""
+    if context:
+        instructions = (
+            "You are a helpful assistant answering questions about the user's uploaded PDFs. "
+            "Answer from the document excerpts below and cite the file and page when useful. "
+            "If the excerpts don't contain the answer, say so.\n\n"
+            f"Document excerpts:\n{context}"
+        )
+    else:
+        instructions = (
+            "You are a helpful assistant for the user's uploaded PDFs. No document "
+            "excerpts were retrieved for this message; reply briefly, and if the user "
+            "asks about a document that isn't uploaded, ask them to upload a PDF."
+        )
+    messages = [SystemMessage(content=instructions + _summary_note(state)), *state["messages"]]
+    with span("llm.answer_node"):
+        response = _lazy("llm").invoke(messages, config=config)
+    _record_prompt(_thread_id_from(config), state, messages, response)
+    _remember_answer(state, response, config)
     return {"messages": [response]}
 
 
-tool_node = ToolNode(tools)
+# -------------------
+# 6b. History compaction  (keeps prompts and chatbot.db bounded over long sessions)
+# -------------------
+# Estimated tokens of history re-sent per turn; older whole turns beyond it are compacted away
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# "trim" drops old turns; "summarize" folds them into a running summary (one extra LLM call)
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "trim")
+# Checkpoints kept per thread in chatbot.db (0 = keep all)
+CHECKPOINT_KEEP = int(os.getenv("CHECKPOINT_KEEP", "20"))
+CHECKPOINT_DB = "chatbot.db"
+# Read-only connections for history loads; writes go through one locked writer
+CHECKPOINT_READERS = int(os.getenv("CHECKPOINT_READERS", "4"))
+
+_PROMPT_LOG: deque = deque(maxlen=2000)  # (thread_id, turn, estimated, billed) per LLM call
+_PROMPT_LOCK = threading.Lock()
+_compaction_counters = {"tool_messages_compacted": 0, "turns_dropped": 0, "checkpoints_pruned": 0}
+
+
+def _message_text(message: BaseMessage) -> str:
+    content = message.content
+    return content if isinstance(content, str) else json.dumps(content, default=str)
+
+
+def _estimate_tokens(messages: List[BaseMessage]) -> int:
+    """Rough prompt size, including per-message overhead."""
+    total = 0
+    for message in messages:
+        total += _text_tokens(_message_text(message)) + 4
+        for call in getattr(message, "tool_calls", None) or []:
+            total += len(json.dumps(call.get("args", {}), default=str)) // 4
+    return total
+
+
+def _summary_note(state: ChatState) -> str:
+    summary = state.get("summary")
+    return f"\n\nSummary of the earlier conversation:\n{summary}" if summary else ""
+
+
+def _record_prompt(thread_id, state: ChatState, messages: List[BaseMessage], response) -> None:
+    # The current question's id identifies the turn (agent mode makes two calls per turn)
+    from langchain_core.messages import HumanMessage
+
+    turn = next((m.id for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), None)
+    billed = (getattr(response, "usage_metadata", None) or {}).get("input_tokens")
+    with _PROMPT_LOCK:
+        _PROMPT_LOG.append((str(thread_id), turn, _estimate_tokens(messages), billed))
+
+
+def _compact_tool_message(message: ToolMessage) -> Optional[ToolMessage]:
+    """Same-id replacement whose payload keeps only chunk-ID references to the excerpts."""
+    from langchain_core.messages import ToolMessage
+
+    try:
+        payload = json.loads(message.content)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(payload, dict) or "context" not in payload:
+        return None  # already compacted, or an error / non-RAG tool result
+    return ToolMessage(
+        id=message.id,
+        tool_call_id=message.tool_call_id,
+        name=message.name,
+        content=json.dumps(
+            {
+                "query": payload.get("query"),
+                "chunk_ids": [s["chunk_id"] for s in payload.get("scores", [])],
+                "source_files": payload.get("source_files", []),
+                "note": "Excerpts from an earlier turn were omitted; call rag_tool again if needed.",
+            }
+        ),
+    )
+
+
+def _split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Group messages into turns, each starting at a HumanMessage."""
+    from langchain_core.messages import HumanMessage
+
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _summarize(previous: str, dropped: List[BaseMessage], config=None) -> str:
+    from langchain_core.messages import HumanMessage
+
+    transcript = "\n".join(
+        f"{m.type}: {_message_text(m)[:2000]}" for m in dropped if m.type in ("human", "ai") and m.content
+    )
+    prompt = (
+        "Update the running summary of a conversation about the user's PDFs. Keep facts, "
+        "answers and open questions; be concise.\n\n"
+        f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"
+    )
+    return _message_text(_lazy("llm").invoke([HumanMessage(content=prompt)], config=config))
+
+
+# checkpoint ids are time-ordered (uuid6), so they sort chronologically
+_PRUNE_CHECKPOINTS_SQL = """
+    DELETE FROM checkpoints
+    WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''
+        ORDER BY checkpoint_id DESC LIMIT ?
+    )
+"""
+_PRUNE_WRITES_SQL = """
+    DELETE FROM writes
+    WHERE thread_id = ? AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints WHERE thread_id = ?
+    )
+"""
+
+
+def prune_checkpoints(checkpointer, thread_id: str, keep: int = CHECKPOINT_KEEP) -> int:
+    """
+    Delete all but the latest ``keep`` checkpoints (and their writes) of a thread.
+    An ``AsyncSqliteSaver`` is pruned on its own event loop, so like its other
+    sync methods this must then be called from a worker thread (as sync graph
+    nodes are under ``astream``).
+    """
+    from langgraph.checkpoint.sqlite import SqliteSaver  # requires: pip install langgraph-checkpoint-sqlite
+
+    if keep <= 0:
+        return 0
+    if isinstance(checkpointer, SqliteSaver):
+        with checkpointer.cursor() as cur:
+            cur.execute(_PRUNE_CHECKPOINTS_SQL, (str(thread_id), str(thread_id), keep))
+            pruned = cur.rowcount
+            cur.execute(_PRUNE_WRITES_SQL, (str(thread_id), str(thread_id)))
+        _compaction_counters["checkpoints_pruned"] += pruned
+        return pruned
+    if checkpointer is None:
+        return 0
+    try:
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+    except ImportError:  # no aiosqlite, so no async saver either
+        return 0
+    if not isinstance(checkpointer, AsyncSqliteSaver):
+        return 0
+    return asyncio.run_coroutine_threadsafe(
+        aprune_checkpoints(checkpointer, thread_id, keep), checkpointer.loop
+    ).result()
+
+
+async def aprune_checkpoints(checkpointer, thread_id: str, keep: int = CHECKPOINT_KEEP) -> int:
+    """``prune_checkpoints`` for an ``AsyncSqliteSaver``, awaited on its loop."""
+    if keep <= 0:
+        return 0
+    async with checkpointer.lock, checkpointer.conn.cursor() as cur:
+        await cur.execute(_PRUNE_CHECKPOINTS_SQL, (str(thread_id), str(thread_id), keep))
+        pruned = cur.rowcount
+        await cur.execute(_PRUNE_WRITES_SQL, (str(thread_id), str(thread_id)))
+        await checkpointer.conn.commit()
+    _compaction_counters["checkpoints_pruned"] += pruned
+    return pruned
+
+
+def compact_node(state: ChatState, config=None, checkpointer=None):
+    """
+    Runs once at the start of every turn: strips excerpts from earlier tool
+    results, drops (or summarizes) the oldest turns beyond HISTORY_TOKEN_BUDGET
+    and prunes old checkpoints of the thread.
+    """
+    from langchain_core.messages import HumanMessage, RemoveMessage, ToolMessage
+
+    turns = _split_turns(state["messages"])
+    updates: List[BaseMessage] = []
+    compacted_turns = []
+    for turn in turns[:-1]:
+        compacted = []
+        for message in turn:
+            replacement = _compact_tool_message(message) if isinstance(message, ToolMessage) else None
+            if replacement is not None:
+                updates.append(replacement)
+                message = replacement
+            compacted.append(message)
+        compacted_turns.append(compacted)
+    _compaction_counters["tool_messages_compacted"] += len(updates)
+
+    total = _estimate_tokens([m for turn in compacted_turns for m in turn]) + _estimate_tokens(
+        turns[-1] if turns else []
+    )
+    dropped: List[BaseMessage] = []
+    while compacted_turns and total > HISTORY_TOKEN_BUDGET:
+        turn = compacted_turns.pop(0)
+        total -= _estimate_tokens(turn)
+        dropped.extend(turn)
+    _compaction_counters["turns_dropped"] += sum(isinstance(m, HumanMessage) for m in dropped)
+
+    dropped_ids = {m.id for m in dropped}
+    updates = [m for m in updates if m.id not in dropped_ids]
+    updates.extend(RemoveMessage(id=m.id) for m in dropped)
+    result: Dict[str, Any] = {"messages": updates}
+    if dropped and HISTORY_COMPACTION == "summarize":
+        result["summary"] = _summarize(state.get("summary", ""), dropped, config)
+
+    thread_id = _thread_id_from(config)
+    if thread_id is not None:
+        prune_checkpoints(checkpointer, thread_id)
+    return result
+
+
+def history_stats() -> dict:
+    """Prompt tokens per turn (summed over the turn's LLM calls) and checkpoint DB size."""
+    with _PROMPT_LOCK:
+        log = list(_PROMPT_LOG)
+    per_turn: Dict[tuple, list] = {}
+    for thread_id, turn, estimated, billed in log:
+        entry = per_turn.setdefault((thread_id, turn), [0, 0])
+        entry[0] += estimated
+        entry[1] += billed or 0
+    estimated = [e for e, _ in per_turn.values()]
+    billed = [b for _, b in per_turn.values() if b]
+    db_bytes = sum(
+        os.path.getsize(CHECKPOINT_DB + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(CHECKPOINT_DB + suffix)
+    )
+    return {
+        "turns": len(per_turn),
+        "prompt_tokens_last": estimated[-1] if estimated else 0,
+        "prompt_tokens_mean": round(float(np.mean(estimated)), 1) if estimated else 0.0,
+        "prompt_tokens_p95": float(np.percentile(estimated, 95)) if estimated else 0.0,
+        "billed_input_tokens_mean": round(float(np.mean(billed)), 1) if billed else None,
+        "checkpoint_db_bytes": db_bytes,
+        **_compaction_counters,
+    }
+
+
+# -------------------
+# 6c. Semantic answer cache  (opt-in: ANSWER_CACHE=1)
+# -------------------
+# Document-grounded answers are reused for near-duplicate questions on the same set of
+# documents, across threads. Off by default: a follow-up like "and the second one?"
+# only makes sense in its own conversation, so enable it for FAQ-style deployments.
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))  # cosine
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+# Graph nodes whose messages are the assistant's answer (what chat UIs should render)
+ANSWER_NODES = ("chat_node", "cached_answer")
+
+
+class _SemanticAnswerCache:
+    """Nearest-neighbour lookup of past questions, grouped by knowledge base."""
+
+    def __init__(self, max_entries: int, threshold: float):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        # kb key -> {"vectors": (n, dim) unit float32 matrix, "entries": [dict, ...]}
+        self._groups: Dict[str, dict] = {}
+        self._clock = 0
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        return v / (np.linalg.norm(v) + 1e-12)
+
+    def _nearest(self, group: dict, query: np.ndarray) -> tuple[int, float]:
+        sims = group["vectors"] @ query
+        best = int(np.argmax(sims))
+        return best, float(sims[best])
+
+    def lookup(self, kb: str, vector: List[float]) -> Optional[dict]:
+        with self.lock:
+            group = self._groups.get(kb)
+            if group is not None:
+                best, similarity = self._nearest(group, self._unit(vector))
+                if similarity >= self.threshold:
+                    self.hits += 1
+                    self._clock += 1
+                    entry = group["entries"][best]
+                    entry["last_used"] = self._clock
+                    return {**entry, "similarity": similarity}
+            self.misses += 1
+            return None
+
+    def store(self, kb: str, question: str, vector: List[float], answer: str) -> None:
+        if self.max_entries <= 0:
+            return
+        query = self._unit(vector)
+        with self.lock:
+            self._clock += 1
+            entry = {"question": question, "answer": answer, "last_used": self._clock}
+            group = self._groups.get(kb)
+            if group is None:
+                self._groups[kb] = {"vectors": query[None, :], "entries": [entry]}
+            else:
+                best, similarity = self._nearest(group, query)
+                if similarity >= self.threshold:
+                    group["entries"][best] = entry  # refresh the near-duplicate
+                    return
+                group["vectors"] = np.vstack([group["vectors"], query])
+                group["entries"].append(entry)
+            while sum(len(g["entries"]) for g in self._groups.values()) > self.max_entries:
+                self._evict_one()
+
+    def _evict_one(self) -> None:
+        kb, index = min(
+            ((kb, i) for kb, g in self._groups.items() for i in range(len(g["entries"]))),
+            key=lambda pos: self._groups[pos[0]]["entries"][pos[1]]["last_used"],
+        )
+        group = self._groups[kb]
+        del group["entries"][index]
+        group["vectors"] = np.delete(group["vectors"], index, axis=0)
+        if not group["entries"]:
+            del self._groups[kb]
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE,
+                "entries": sum(len(g["entries"]) for g in self._groups.values()),
+                "knowledge_bases": len(self._groups),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+answer_cache = _SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD)
+
+
+def _knowledge_base_key(thread_id: Optional[str]) -> Optional[str]:
+    """Identity of the thread's document set (doc ids are content hashes)."""
+    if not thread_id:
+        return None
+    doc_ids = sorted(f["doc_id"] for f in _thread_files(thread_id))
+    return f"{EMBEDDING_MODEL_ID}|{','.join(doc_ids)}" if doc_ids else None
+
+
+def cached_answer_node(state: ChatState, config=None):
+    """Serve a stored answer to a near-duplicate question, or fall through (empty update)."""
+    from langchain_core.messages import AIMessage
+
+    question = _last_question(state)
+    kb = _knowledge_base_key(_thread_id_from(config))
+    if kb is None or not question or _CHITCHAT_RE.match(question):
+        return {}
+    with span("graph.answer_cache"):
+        hit = answer_cache.lookup(kb, _embed_query(question))
+    if hit is None:
+        return {}
+    return {"messages": [AIMessage(content=hit["answer"], response_metadata={"answer_cache": True})]}
+
+
+def route_after_answer_cache(state: ChatState) -> str:
+    from langchain_core.messages import AIMessage
+    from langgraph.graph import END
+
+    last = state["messages"][-1]
+    return END if isinstance(last, AIMessage) else "miss"
+
+
+def _remember_answer(state: ChatState, response, config=None) -> None:
+    """Store a final answer if this turn actually drew on the documents."""
+    from langchain_core.messages import ToolMessage
+
+    if not ANSWER_CACHE or getattr(response, "tool_calls", None):
+        return
+    if not isinstance(response.content, str) or not response.content.strip():
+        return
+    turn = _split_turns(state["messages"])[-1] if state["messages"] else []
+    grounded = bool(state.get("context")) or any(
+        isinstance(m, ToolMessage) and m.name == "rag_tool" and '"context"' in _message_text(m)
+        for m in turn
+    )
+    kb = _knowledge_base_key(_thread_id_from(config))
+    question = _last_question(state)
+    if grounded and kb is not None and question:
+        answer_cache.store(kb, question, _embed_query(question), response.content)
+
+
+def answer_cache_stats() -> dict:
+    return answer_cache.stats()
+
+
+def _build_tool_node():
+    from langgraph.prebuilt import ToolNode
+
+    return ToolNode(_lazy("tools"))
 
 # -------------------
-# 6. Checkpointer + 7. Graph  (cached so the graph is compiled only ONCE)
+# 6d. Thread registry  (one row per thread in chatbot.db, kept current at write time)
 # -------------------
+THREAD_SORT_COLUMNS = ("last_activity", "created_at", "message_count", "thread_id")
+
+
+class _ThreadRegistry:
+    """
+    Per-thread summary rows next to the checkpoints: activity, message count
+    and the documents in the thread's knowledge base.
+
+    Rows are written when a turn is checkpointed or a document is attached or
+    removed, so listing threads and reading their metadata are indexed
+    lookups instead of scans over every checkpoint. Writes go through the
+    checkpointer's writer connection, reads through its reader pool.
+    """
+
+    def __init__(self, saver: PooledSqliteSaver):
+        self.saver = saver
+        with saver.cursor() as cur:
+            cur.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    last_activity REAL NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS threads_by_activity ON threads (last_activity);
+                CREATE TABLE IF NOT EXISTS thread_documents (
+                    thread_id TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    pages INTEGER NOT NULL,
+                    chunks INTEGER NOT NULL,
+                    added_at REAL NOT NULL,
+                    PRIMARY KEY (thread_id, doc_id)
+                );
+                """
+            )
+            empty = cur.execute("SELECT NOT EXISTS (SELECT 1 FROM threads)").fetchone()[0]
+        if empty:
+            self._backfill()
+
+    def _backfill(self) -> None:
+        """One-off import of threads that predate the registry (checkpoints + the index manifest)."""
+        with self.saver.cursor(transaction=False) as cur:
+            thread_ids = [row[0] for row in cur.execute(
+                "SELECT DISTINCT thread_id FROM checkpoints WHERE checkpoint_ns = ''"
+            )]
+        for thread_id in thread_ids:
+            latest = self.saver.get_tuple({"configurable": {"thread_id": thread_id}})
+            if latest is None:
+                continue
+            messages = latest.checkpoint["channel_values"].get("messages", [])
+            at = datetime.fromisoformat(latest.checkpoint["ts"]).timestamp()
+            self.touch(thread_id, len(messages), at=at)
+        for name in _lazy("index_store").threads():
+            files = _lazy("index_store").metadata(name).get("files", [])
+            if files:
+                self.set_documents(name, files, at=max(f["added_at"] for f in files))
+
+    def touch(self, thread_id: str, message_count: Optional[int] = None, at: Optional[float] = None) -> None:
+        now = at or time.time()
+        with self.saver.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO threads (thread_id, created_at, last_activity, message_count)
+                VALUES (?, ?, ?, COALESCE(?, 0))
+                ON CONFLICT (thread_id) DO UPDATE SET
+                    last_activity = excluded.last_activity,
+                    message_count = COALESCE(?, message_count)
+                """,
+                (str(thread_id), now, now, message_count, message_count),
+            )
+
+    def set_documents(self, thread_id: str, files: List[dict], at: Optional[float] = None) -> None:
+        """Replace the thread's document rows with ``files`` (index store metadata)."""
+        thread_id = str(thread_id)
+        now = at or time.time()
+        with self.saver.cursor() as cur:
+            cur.execute("DELETE FROM thread_documents WHERE thread_id = ?", (thread_id,))
+            cur.executemany(
+                "INSERT INTO thread_documents VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (thread_id, f["doc_id"], f["filename"], f["pages"], f["chunks"], f.get("added_at", now))
+                    for f in files
+                ],
+            )
+            cur.execute(
+                """
+                INSERT INTO threads (thread_id, created_at, last_activity) VALUES (?, ?, ?)
+                ON CONFLICT (thread_id) DO UPDATE SET
+                    last_activity = MAX(last_activity, excluded.last_activity)
+                """,
+                (thread_id, now, now),
+            )
+
+    def forget(self, thread_id: str) -> None:
+        with self.saver.cursor() as cur:
+            cur.execute("DELETE FROM thread_documents WHERE thread_id = ?", (str(thread_id),))
+            cur.execute("DELETE FROM threads WHERE thread_id = ?", (str(thread_id),))
+
+    def documents(self, thread_id: str) -> List[dict]:
+        with self.saver.cursor(transaction=False) as cur:
+            cur.execute(
+                """
+                SELECT doc_id, filename, pages, chunks, added_at FROM thread_documents
+                WHERE thread_id = ? ORDER BY added_at
+                """,
+                (str(thread_id),),
+            )
+            columns = [c[0] for c in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def list(
+        self,
+        limit: Optional[int] = 50,
+        offset: int = 0,
+        order_by: str = "last_activity",
+        descending: bool = True,
+    ) -> List[dict]:
+        if order_by not in THREAD_SORT_COLUMNS:
+            raise ValueError(f"order_by must be one of {THREAD_SORT_COLUMNS}")
+        direction = "DESC" if descending else "ASC"
+        with self.saver.cursor(transaction=False) as cur:
+            cur.execute(
+                f"""
+                SELECT t.thread_id, t.created_at, t.last_activity, t.message_count,
+                       COUNT(d.doc_id) AS documents, COALESCE(SUM(d.chunks), 0) AS chunks,
+                       (SELECT filename FROM thread_documents
+                        WHERE thread_id = t.thread_id ORDER BY added_at DESC LIMIT 1) AS filename
+                FROM (
+                    SELECT * FROM threads ORDER BY {order_by} {direction}, thread_id LIMIT ? OFFSET ?
+                ) AS t
+                LEFT JOIN thread_documents AS d ON d.thread_id = t.thread_id
+                GROUP BY t.thread_id
+                ORDER BY t.{order_by} {direction}, t.thread_id
+                """,
+                (-1 if limit is None else limit, offset),
+            )
+            columns = [c[0] for c in cur.description]
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def count(self) -> int:
+        with self.saver.cursor(transaction=False) as cur:
+            return cur.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+
+
+class _RegistryHooks:
+    """Mixed into ``PooledSqliteSaver``: refreshes the thread's registry row when its messages change."""
+
+    registry: Optional[_ThreadRegistry] = None
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        configurable = config["configurable"]
+        if self.registry is not None and not configurable.get("checkpoint_ns") and "messages" in new_versions:
+            messages = checkpoint["channel_values"].get("messages")
+            self.registry.touch(configurable["thread_id"], len(messages) if messages is not None else None)
+        return saved
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        if self.registry is not None:
+            self.registry.forget(thread_id)
+
+
 @st.cache_resource(show_spinner=False)
-def _build_chatbot():
-    conn = sqlite3.connect(database="chatbot.db", check_same_thread=False)
-    checkpointer = SqliteSaver(conn=conn)
+def _load_checkpointer():
+    from sqlite_saver import PooledSqliteSaver
+
+    saver_cls = type("_RegistrySaver", (_RegistryHooks, PooledSqliteSaver), {})
+    saver = saver_cls(CHECKPOINT_DB, readers=CHECKPOINT_READERS)
+    saver.registry = _ThreadRegistry(saver)
+    return saver
+
+
+def _sync_thread_registry(thread_id: str) -> None:
+    """Copy the thread's document list from the index store into the registry."""
+    _lazy("thread_registry").set_documents(thread_id, _thread_files(thread_id))
+
+
+class _AsyncRegistryHooks:
+    """``_RegistryHooks`` for ``AsyncSqliteSaver``, on its async methods."""
+
+    registry: Optional[_ThreadRegistry] = None
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        saved = await super().aput(config, checkpoint, metadata, new_versions)
+        configurable = config["configurable"]
+        if self.registry is not None and not configurable.get("checkpoint_ns") and "messages" in new_versions:
+            messages = checkpoint["channel_values"].get("messages")
+            await asyncio.to_thread(
+                self.registry.touch, configurable["thread_id"], len(messages) if messages is not None else None
+            )
+        return saved
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await super().adelete_thread(thread_id)
+        if self.registry is not None:
+            await asyncio.to_thread(self.registry.forget, thread_id)
+
+
+@asynccontextmanager
+async def open_async_checkpointer() -> AsyncIterator[Any]:
+    """
+    Async checkpointer on CHECKPOINT_DB for ``chatbot.astream`` under asyncio
+    servers (``_build_graph(checkpointer=...)``). Like the sync checkpointer
+    it keeps ``thread_registry`` current, and ``compact_node`` prunes it.
+    Needs ``aiosqlite``.
+    """
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    from sqlite_saver import open_async_checkpointer as open_async_sqlite
+
+    saver_cls = type("_AsyncRegistrySaver", (_AsyncRegistryHooks, AsyncSqliteSaver), {})
+    async with open_async_sqlite(CHECKPOINT_DB, saver_cls) as saver:
+        saver.registry = _lazy("thread_registry")
+        yield saver
+
+
+# -------------------
+# 7. Checkpointer + 8. Graph  (cached so the graph is compiled only ONCE)
+# -------------------
+def _build_graph(mode: str = CHAT_GRAPH_MODE, checkpointer=None, answer_cache: bool = ANSWER_CACHE):
+    """Compile the chat graph for ``mode`` ("agent" or "preretrieval")."""
+    # LangGraph resolves ChatState's annotations against this module's globals
+    global BaseMessage, add_messages
+    from langchain_core.messages import BaseMessage
+    from langgraph.graph import END, START, StateGraph
+    from langgraph.graph.message import add_messages
+    from langgraph.prebuilt import tools_condition
 
     graph = StateGraph(ChatState)
-    graph.add_node("chat_node", chat_node)
-    graph.add_node("tools", tool_node)
 
-    graph.add_edge(START, "chat_node")
-    graph.add_conditional_edges("chat_node", tools_condition)
-    graph.add_edge("tools", "chat_node")
+    def compact(state: ChatState, config):
+        with span("graph.compact"):
+            return compact_node(state, config, checkpointer)
+
+    graph.add_node("compact", compact)
+    graph.add_edge(START, "compact")
+    if mode == "agent":
+        first = "chat_node"
+        graph.add_node("chat_node", chat_node)
+        graph.add_node("tools", _lazy("tool_node"))
+
+        graph.add_conditional_edges("chat_node", tools_condition)
+        graph.add_edge("tools", "chat_node")
+    elif mode == "preretrieval":
+        # The answer node keeps the name "chat_node" so streaming consumers filter the same way
+        first = "retrieve"
+        graph.add_node("retrieve", retrieve_node)
+        graph.add_node("chat_node", answer_node)
 
+        graph.add_edge("retrieve", "chat_node")
+        graph.add_edge("chat_node", END)
+    else:
+        raise ValueError(f"Unknown CHAT_GRAPH_MODE: {mode!r}")
+
+    if answer_cache:
+        graph.add_node("cached_answer", cached_answer_node)
+        graph.add_edge("compact", "cached_answer")
+        graph.add_conditional_edges(
+            "cached_answer", route_after_answer_cache, {END: END, "miss": first}
+        )
+    else:
+        graph.add_edge("compact", first)
     return graph.compile(checkpointer=checkpointer)
 
-chatbot = _build_chatbot()
+
+@st.cache_resource(show_spinner=False)
+def _build_chatbot():
+    return _build_graph(CHAT_GRAPH_MODE, _lazy("checkpointer"))
+
+if STARTUP_MODE == "eager":
+    prewarm()
+
 
 # -------------------
-# 8. Helpers
+# 9. Helpers
 # -------------------
 def retrieve_all_threads():
-    all_threads = set()
-    for checkpoint in checkpointer.list(None):
-        all_threads.add(checkpoint.config["configurable"]["thread_id"])
-    return list(all_threads)
+    return [t["thread_id"] for t in _lazy("thread_registry").list(limit=None)]
+
+
+def list_threads(
+    limit: int = 50, offset: int = 0, order_by: str = "last_activity", descending: bool = True
+) -> dict:
+    """
+    One page of threads from the registry, most recently active first by default.
+
+    Each row has ``thread_id``, ``created_at``, ``last_activity``,
+    ``message_count``, ``documents``, ``chunks`` and the latest ``filename``.
+    """
+    return {
+        "threads": _lazy("thread_registry").list(limit, offset, order_by, descending),
+        "total": _lazy("thread_registry").count(),
+        "limit": limit,
+        "offset": offset,
+    }
 
 
 def thread_has_document(thread_id: str) -> bool:
-    return str(thread_id) in _THREAD_RETRIEVERS
+    return bool(_lazy("thread_registry").documents(thread_id))
 
 
 def thread_document_metadata(thread_id: str) -> dict:
-    return _THREAD_METADATA.get(str(thread_id), {})
+    """Totals for the thread's knowledge base plus per-document page/chunk counts."""
+    files = _lazy("thread_registry").documents(thread_id)
+    if not files:
+        return {}
+    return {
+        "filename": files[-1]["filename"],
+        "documents": sum(f["pages"] for f in files),
+        "chunks": sum(f["chunks"] for f in files),
+        "files": files,
+    }
+
+
+def remove_document(thread_id: str, doc_id: str) -> bool:
+    """Remove one document (and only its chunks) from the thread's knowledge base."""
+    removed = _lazy("index_store").remove_document(str(thread_id), doc_id)
+    invalidate_retrieval_cache(thread_id)
+    _sync_thread_registry(thread_id)
+    return removed
+
+
+def delete_thread_documents(thread_id: str) -> None:
+    """Release all of a thread's documents; shared indexes are freed with their last thread."""
+    _lazy("index_store").delete_thread(str(thread_id))
+    invalidate_retrieval_cache(thread_id)
+    _lazy("thread_registry").set_documents(thread_id, [])
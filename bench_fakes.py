@@ -0,0 +1,223 @@
+"""
+Deterministic, offline stand-ins for the embedding endpoint and Gemini.
+
+Used by ``benchmark.py offline`` so ingestion and chat turns can be timed
+without network access or API keys:
+
+    import RAG_backend as rb
+    from bench_fakes import FakeChatModel, FakeEmbeddings
+
+    rb.embeddings = FakeEmbeddings(latency=0.05, throttle_rate=0.05)
+    rb.llm = FakeChatModel(ttft=0.3, token_latency=0.01)
+    rb.llm_with_tools = rb.llm.bind_tools(rb.tools)
+
+Both can inject latency and HTTP 429s. The embedding stand-in raises them
+to the caller, so the backend's scheduler does the retrying. The chat
+stand-in retries internally, as the Gemini client does.
+"""
+from __future__ import annotations
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+_TOKEN_RE = re.compile(r"\w+")
+_THREAD_RE = re.compile(r"thread_id\s+`([^`]+)`")
+_CHITCHAT_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|ok|bye)\b", re.IGNORECASE)
+# Function words carry little weight in a real embedding; hashing them in
+# would give every pair of English sentences a similar-looking cosine.
+_FUNCTION_WORDS = frozenset(
+    "a an and are as at be by did do does for from how in is it of on or that the "
+    "this to was what when where which who why with".split()
+)
+
+
+class FakeThrottleError(Exception):
+    """Looks like a 429 to the backend's ``_throttle_info``."""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__("429 Too Many Requests (injected)")
+        self.retry_after = retry_after
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Hashed bag-of-words vectors: texts sharing words land close together, so
+    retrieval, thresholds and context packing behave like they do with real
+    embeddings. Every call sleeps ``latency`` (+ ``per_text`` per input).
+    """
+
+    def __init__(
+        self,
+        dim: int = 384,
+        latency: float = 0.0,
+        per_text: float = 0.0,
+        throttle_rate: float = 0.0,
+        seed: int = 7,
+    ):
+        self.dim = dim
+        self.latency = latency
+        self.per_text = per_text
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.texts = 0
+        self.throttled = 0
+
+    def _vector(self, text: str) -> List[float]:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for token in _TOKEN_RE.findall(text.lower()):
+            if token in _FUNCTION_WORDS:
+                continue
+            h = zlib.crc32(token.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).tolist()
+
+    def _call(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            self.calls += 1
+            throttle = self._rng.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+            else:
+                self.texts += len(texts)
+        time.sleep(self.latency + self.per_text * len(texts))
+        if throttle:
+            raise FakeThrottleError()
+        return [self._vector(t) for t in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._call(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call([text])[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "texts": self.texts, "throttled": self.throttled}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Scripted chat model that streams word by word.
+
+    With tools bound it behaves like the agent graph expects: a question
+    gets one ``rag_tool`` call (thread id taken from the system prompt), and
+    the tool result gets a final answer. Chit-chat is answered directly.
+    """
+
+    ttft: float = 0.3
+    token_latency: float = 0.01
+    answer_words: int = 60
+    throttle_rate: float = 0.0
+    max_retries: int = 6
+    backoff: float = 0.05
+    seed: int = 7
+
+    _rng: random.Random = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _counters: dict = PrivateAttr(default_factory=lambda: {"calls": 0, "throttled": 0})
+
+    def model_post_init(self, __context: Any) -> None:
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    # -- behaviour -----------------------------------------------------------
+    def _wait_for_slot(self) -> None:
+        """Injected 429s, retried with exponential backoff like a real client."""
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                self._counters["calls"] += 1
+                throttled = self._rng.random() < self.throttle_rate
+                if throttled:
+                    self._counters["throttled"] += 1
+            if not throttled:
+                return
+            time.sleep(self.backoff * 2**attempt)
+        raise FakeThrottleError()
+
+    def _reply(self, messages: List[BaseMessage], tools: Optional[list]) -> AIMessage:
+        last = messages[-1]
+        question = next(
+            (m.content for m in reversed(messages) if isinstance(m, HumanMessage)), ""
+        )
+        if tools and isinstance(last, HumanMessage) and not _CHITCHAT_RE.match(str(question)):
+            system = str(messages[0].content) if messages else ""
+            match = _THREAD_RE.search(system)
+            args = {"query": str(question), "thread_id": match.group(1) if match else None}
+            return AIMessage(
+                content="",
+                tool_calls=[{"name": "rag_tool", "args": args, "id": f"call_{uuid.uuid4().hex[:12]}"}],
+            )
+        grounded = isinstance(last, ToolMessage) or "Document excerpts:" in str(messages[0].content)
+        words = _TOKEN_RE.findall(str(question)) or ["answer"]
+        body = [words[i % len(words)] for i in range(self.answer_words)]
+        prefix = "According to the document," if grounded else "Hello!"
+        return AIMessage(content=" ".join([prefix, *body]) + ".")
+
+    def _usage(self, messages: List[BaseMessage], reply: AIMessage) -> dict:
+        prompt = sum(len(str(m.content)) for m in messages) // 4
+        output = max(1, len(str(reply.content)) // 4)
+        return {"input_tokens": prompt, "output_tokens": output, "total_tokens": prompt + output}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self._wait_for_slot()
+        reply = self._reply(messages, kwargs.get("tools"))
+        time.sleep(self.ttft + self.token_latency * len(str(reply.content).split()))
+        reply.usage_metadata = self._usage(messages, reply)
+        reply.response_metadata["model_name"] = self._llm_type  # usage callbacks key on it
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        self._wait_for_slot()
+        reply = self._reply(messages, kwargs.get("tools"))
+        time.sleep(self.ttft)
+        if reply.tool_calls:
+            call = reply.tool_calls[0]
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[
+                        {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": 0}
+                    ],
+                    usage_metadata=self._usage(messages, reply),
+                    response_metadata={"model_name": self._llm_type},
+                )
+            )
+            return
+        words = str(reply.content).split(" ")
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            chunk = AIMessageChunk(content=word if i == 0 else " " + word)
+            if i == len(words) - 1:
+                chunk.usage_metadata = self._usage(messages, reply)
+                chunk.response_metadata = {"model_name": self._llm_type}
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=ChatGenerationChunk(message=chunk))
+            yield ChatGenerationChunk(message=chunk)
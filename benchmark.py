@@ -0,0 +1,972 @@
+"""
+Performance benchmarks for QueryMyPDF.
+
+    python benchmark.py embeddings --chunks 256 --backends remote local local:int8 local:onnx
+    python benchmark.py extract --pages 500 --workers 1 2 4 8
+    python benchmark.py bm25 --sizes 1000 10000 100000
+    python benchmark.py faiss --sizes 5000 50000 --nprobe 4 16 64 --ef 32 64 128
+    python benchmark.py graph --modes agent preretrieval   # needs GOOGLE_API_KEY + HF_TOKEN
+    python benchmark.py graph --offline                     # same, against local stand-ins
+    python benchmark.py offline --pages 200 --out bench-$(git rev-parse --short HEAD).json
+    python benchmark.py render --tokens 400 --turns 5 20 50
+    python benchmark.py checkpoints --sessions 1 4 16 --turns 10
+    python benchmark.py memory --chunks 1000 10000 50000
+    python benchmark.py coldstart --modes eager lazy --repeat 3
+
+Results are printed as JSON.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+# Constructing the Gemini client needs a key (at import with STARTUP_MODE=eager); the
+# offline benchmarks never call it
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark-placeholder")
+
+_WORDS = (
+    "agreement party shall notice term payment refund warranty liability section "
+    "clause service customer provider period written obligation data device manual "
+    "install configure battery replace support schedule invoice delivery return"
+).split()
+
+
+def synthetic_chunks(n: int, min_chars: int = 200, max_chars: int = 1500, seed: int = 7) -> List[str]:
+    """Deterministic pseudo-document chunks with a realistic spread of lengths."""
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        target = rng.randint(min_chars, max_chars)
+        words: List[str] = [f"chunk{i}"]
+        while sum(len(w) + 1 for w in words) < target:
+            words.append(rng.choice(_WORDS))
+        chunks.append(" ".join(words))
+    return chunks
+
+
+def synthetic_pdf(
+    pages: int, lines_per_page: int = 45, seed: int = 7, words: Sequence[str] = _WORDS
+) -> bytes:
+    """Build a text-only PDF (Helvetica, one content stream per page) in memory."""
+    rng = random.Random(seed)
+    objects: List[bytes] = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    contents = []
+    for p in range(pages):
+        lines = []
+        for l in range(lines_per_page):
+            line = " ".join(rng.choice(words) for _ in range(12))
+            lines.append(f"(p{p} l{l} {line}) '")
+        stream = f"BT /F1 9 Tf 36 806 Td 11 TL {' '.join(lines)} ET".encode("latin-1")
+        contents.append(add(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)))
+    pages_id = len(objects) + pages + 1
+    kids = [
+        add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, c, font)
+        )
+        for c in contents
+    ]
+    add(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), pages))
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog, xref,
+    )
+    return bytes(out)
+
+
+def bench_extract(args) -> dict:
+    """Pages/sec of PDF text extraction per worker count."""
+    from pdf_extract import iter_page_texts
+
+    data = synthetic_pdf(args.pages)
+    results = {"pages": args.pages, "cpus": os.cpu_count(), "runs": {}}
+    baseline = None
+    for workers in args.workers:
+        started = time.perf_counter()
+        n = sum(1 for _ in iter_page_texts(data, workers=workers, min_pages=0))
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        results["runs"][str(workers)] = {
+            "seconds": round(elapsed, 3),
+            "pages_per_sec": round(n / elapsed, 1),
+            "speedup": round(baseline / elapsed, 2),
+        }
+    return results
+
+
+def bench_bm25(args) -> dict:
+    """Build time, query latency and size: rank_bm25 BM25Retriever vs. the NumPy index."""
+    import tracemalloc
+
+    from langchain_community.retrievers import BM25Retriever
+
+    import RAG_backend as rb
+
+    queries = [" ".join(random.Random(q).sample(_WORDS, 3)) for q in range(args.queries)]
+    results = {}
+    for n in args.sizes:
+        texts = synthetic_chunks(n, min_chars=args.chunk_chars // 2, max_chars=args.chunk_chars)
+        row = {}
+        for name, build, search in (
+            (
+                "rank_bm25",
+                lambda: BM25Retriever.from_texts(texts, k=args.k),
+                lambda index, q: index.invoke(q),
+            ),
+            (
+                "numpy",
+                lambda: rb._BM25Index.from_texts(texts),
+                lambda index, q: index.top_k(q, args.k),
+            ),
+        ):
+            tracemalloc.start()
+            started = time.perf_counter()
+            index = build()
+            build_seconds = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            retained = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            started = time.perf_counter()
+            for q in queries:
+                search(index, q)
+            per_query = (time.perf_counter() - started) / len(queries)
+            row[name] = {
+                "build_seconds": round(build_seconds, 3),
+                "query_ms": round(per_query * 1000, 3),
+                "retained_mb": round(retained / 2**20, 1),
+                "peak_build_mb": round(peak / 2**20, 1),
+            }
+            del index
+        row["query_speedup"] = round(row["rank_bm25"]["query_ms"] / max(row["numpy"]["query_ms"], 1e-9), 1)
+        results[str(n)] = row
+    return results
+
+
+def synthetic_vectors(n: int, dim: int = 384, clusters: int = 64, seed: int = 7):
+    """Unit vectors drawn around random topic centres (embeddings are clustered, not uniform)."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype("float32")
+    vectors = centres[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench_faiss(args) -> dict:
+    """Recall@k vs. memory and query latency for each FAISS index type."""
+    import numpy as np
+
+    import RAG_backend as rb
+
+    results = {}
+    for n in args.sizes:
+        vectors = synthetic_vectors(n + args.queries, seed=n)
+        data, queries = vectors[: n], vectors[n:]
+        exact = rb.build_faiss_index(data, "flat")
+        _, truth = exact.search(queries, args.k)
+        row = {}
+        for kind in args.types:
+            started = time.perf_counter()
+            index = rb.build_faiss_index(data, kind)
+            build_seconds = time.perf_counter() - started
+            # HNSW sweeps efSearch, IVF sweeps nprobe; other types have no knob
+            knob = {
+                "hnsw": ("ef_search", args.ef),
+                "ivfsq8": ("nprobe", args.nprobe),
+                "ivfpq": ("nprobe", args.nprobe),
+            }.get(kind)
+            for value in knob[1] if knob else [None]:
+                if knob:
+                    rb.tune_faiss_index(index, **{knob[0]: value})
+                started = time.perf_counter()
+                found = np.vstack([index.search(q[None, :], args.k)[1] for q in queries])
+                per_query = (time.perf_counter() - started) / len(queries)
+                recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+                name = rb.faiss_index_type(index) + (f"@{knob[0]}={value}" if knob else "")
+                row[name] = {
+                    "build_seconds": round(build_seconds, 3),
+                    "index_mb": round(rb.faiss_index_bytes(index) / 2**20, 2),
+                    "query_ms": round(per_query * 1000, 3),
+                    f"recall@{args.k}": round(float(recall), 4),
+                }
+        results[str(n)] = row
+    return results
+
+
+_DEFAULT_QUESTIONS = [
+    "What does the document say about the refund policy?",
+    "Hi!",
+    "Summarise the warranty and liability clauses.",
+    "Which obligations does the provider have regarding data?",
+    "Thanks!",
+    # Off-topic: should get no document excerpts in pre-retrieval mode
+    "What is the capital of France?",
+    "Who won the football match last night?",
+]
+# Real text is full of stopwords, and BM25 matches on them
+_PROSE_WORDS = _WORDS + "the the the of of and and to is in a for with".split()
+
+
+def bench_graph(args) -> dict:
+    """
+    Time-to-first-token and tokens billed per turn for each chat graph mode.
+    ``--offline`` uses the local stand-ins (scratch directory, no keys).
+    """
+    from langchain_core.callbacks import UsageMetadataCallbackHandler
+    from langchain_core.messages import HumanMessage
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    if args.offline:
+        import tempfile
+
+        workdir = tempfile.mkdtemp(prefix="querymypdf-bench-")
+        os.environ["INDEX_DIR"] = os.path.join(workdir, "indexes")
+        os.environ["EMBED_CACHE_PATH"] = os.path.join(workdir, "embeddings_cache.db")
+        os.chdir(workdir)
+
+    import RAG_backend as rb
+
+    if args.offline:
+        from bench_fakes import FakeChatModel, FakeEmbeddings
+
+        rb.embeddings = FakeEmbeddings()
+        rb.llm = FakeChatModel(ttft=args.llm_ttft, token_latency=args.llm_token_latency)
+        rb.llm_with_tools = rb.llm.bind_tools(rb.tools)
+
+    thread_id = f"bench-graph-{uuid.uuid4()}"
+    rb.ingest_pdf(synthetic_pdf(args.pages, words=_PROSE_WORDS), thread_id, "bench.pdf")
+    questions = args.questions or _DEFAULT_QUESTIONS
+    results = {}
+    try:
+        for mode in args.modes:
+            graph = rb._build_graph(mode, InMemorySaver())
+            turns = []
+            for question in questions:
+                usage = UsageMetadataCallbackHandler()
+                config = {"configurable": {"thread_id": thread_id}, "callbacks": [usage]}
+                started = time.perf_counter()
+                ttft = None
+                for chunk, metadata in graph.stream(
+                    {"messages": [HumanMessage(content=question)]}, config=config, stream_mode="messages"
+                ):
+                    if ttft is None and metadata.get("langgraph_node") in rb.ANSWER_NODES and chunk.content:
+                        ttft = time.perf_counter() - started
+                total = time.perf_counter() - started
+                billed = list(usage.usage_metadata.values())
+                turns.append(
+                    {
+                        "question": question,
+                        "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+                        "total_ms": round(total * 1000, 1),
+                        "input_tokens": sum(u.get("input_tokens", 0) for u in billed),
+                        "output_tokens": sum(u.get("output_tokens", 0) for u in billed),
+                    }
+                )
+            ttfts = [t["ttft_ms"] for t in turns if t["ttft_ms"] is not None]
+            results[mode] = {
+                "median_ttft_ms": statistics.median(ttfts) if ttfts else None,
+                "mean_total_ms": round(statistics.mean(t["total_ms"] for t in turns), 1),
+                "input_tokens": sum(t["input_tokens"] for t in turns),
+                "output_tokens": sum(t["output_tokens"] for t in turns),
+                "turns": turns,
+            }
+    finally:
+        rb.delete_thread_documents(thread_id)
+    return results
+
+
+def _percentiles(values_ms: List[float]) -> dict:
+    ordered = sorted(values_ms)
+    if not ordered:
+        return {}
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50": round(pick(0.5), 3),
+        "p95": round(pick(0.95), 3),
+        "p99": round(pick(0.99), 3),
+        "mean": round(statistics.mean(ordered), 3),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    import subprocess
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_offline(args) -> dict:
+    """
+    Every ingestion and query stage, timed against local stand-ins (no keys,
+    no network). Runs in a scratch directory so nothing touches the real
+    index store, embedding cache or chatbot.db.
+    """
+    import platform
+    import tempfile
+
+    import numpy as np
+
+    workdir = tempfile.mkdtemp(prefix="querymypdf-bench-")
+    os.environ["INDEX_DIR"] = os.path.join(workdir, "indexes")
+    os.environ["EMBED_CACHE_PATH"] = os.path.join(workdir, "embeddings_cache.db")
+    os.chdir(workdir)
+
+    from langchain_core.messages import HumanMessage
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    import RAG_backend as rb
+    from bench_fakes import FakeChatModel, FakeEmbeddings
+
+    fake_embeddings = FakeEmbeddings(
+        latency=args.embed_latency, per_text=args.embed_per_text, throttle_rate=args.embed_throttle
+    )
+    fake_llm = FakeChatModel(
+        ttft=args.llm_ttft, token_latency=args.llm_token_latency, throttle_rate=args.llm_throttle
+    )
+    rb.embeddings = fake_embeddings
+    rb.llm = fake_llm
+    rb.llm_with_tools = fake_llm.bind_tools(rb.tools)
+
+    pdf = synthetic_pdf(args.pages)
+    report: dict = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k != "func"},
+        }
+    }
+
+    # End to end (parse -> split -> embed -> index, overlapped), then a shared re-upload
+    started = time.perf_counter()
+    summary = rb.ingest_pdf(pdf, "bench-a", "bench.pdf")
+    ingest_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    rb.ingest_pdf(pdf, "bench-b", "bench.pdf")
+    report["ingest"] = {
+        "pages": summary["pages"],
+        "chunks": summary["chunks"],
+        "index_type": summary.get("index_type"),
+        "pdf_bytes": len(pdf),
+        "cold_seconds": round(ingest_seconds, 3),
+        "shared_attach_seconds": round(time.perf_counter() - started, 4),
+    }
+
+    # The same stages one at a time (the embed stage bypasses the embedding cache)
+    stages = {}
+    started = time.perf_counter()
+    pages = [doc for _, doc in rb._iter_pdf_pages(pdf, "bench.pdf")]
+    stages["parse"] = time.perf_counter() - started
+    started = time.perf_counter()
+    chunks = rb._make_splitter().split_documents(pages)
+    stages["split"] = time.perf_counter() - started
+    texts = [c.page_content for c in chunks]
+    started = time.perf_counter()
+    vectors = rb._EmbeddingScheduler(fake_embeddings.embed_documents).embed(texts)
+    stages["embed"] = time.perf_counter() - started
+    started = time.perf_counter()
+    rb.build_faiss_index(np.asarray(vectors, dtype=np.float32), rb.choose_faiss_index_type(len(texts)))
+    stages["faiss_build"] = time.perf_counter() - started
+    started = time.perf_counter()
+    rb._BM25Index.from_texts(texts)
+    stages["bm25_build"] = time.perf_counter() - started
+    report["stages_ms"] = {k: round(v * 1000, 3) for k, v in stages.items()}
+
+    # Retrieval: cold (caches cleared per query) vs. warm, and the full rag_tool payload
+    questions = [" ".join(random.Random(q).sample(_WORDS, 3)) for q in range(args.queries)]
+    cold, warm, tool = [], [], []
+    for question in questions:
+        rb.retrieval_cache.invalidate(())
+        rb.query_embedding_cache.invalidate(())
+        started = time.perf_counter()
+        rb.hybrid_search("bench-a", question)
+        cold.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        rb.hybrid_search("bench-a", question)
+        warm.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        rb.rag_tool.invoke({"query": question, "thread_id": "bench-a"})
+        tool.append((time.perf_counter() - started) * 1000)
+    report["retrieval_ms"] = {
+        "hybrid_cold": _percentiles(cold),
+        "hybrid_cached": _percentiles(warm),
+        "rag_tool": _percentiles(tool),
+    }
+
+    # Graph turns through the same stream consumer the UI uses
+    report["graph"] = {}
+    for mode in args.modes:
+        graph = rb._build_graph(mode, InMemorySaver())
+        thread = {"configurable": {"thread_id": "bench-a"}}
+        ttfts, totals = [], []
+        for question in (args.questions or _DEFAULT_QUESTIONS):
+            started = time.perf_counter()
+            ttft = None
+            for chunk, metadata in graph.stream(
+                {"messages": [HumanMessage(content=question)]}, config=thread, stream_mode="messages"
+            ):
+                if ttft is None and metadata.get("langgraph_node") in rb.ANSWER_NODES and chunk.content:
+                    ttft = time.perf_counter() - started
+            totals.append((time.perf_counter() - started) * 1000)
+            if ttft is not None:
+                ttfts.append(ttft * 1000)
+        report["graph"][mode] = {"ttft_ms": _percentiles(ttfts), "turn_ms": _percentiles(totals)}
+
+    report["stand_ins"] = {"embeddings": fake_embeddings.stats(), "llm": fake_llm.stats()}
+    report["backend"] = {
+        "embedding_scheduler": rb.embedding_scheduler_stats(),
+        "query_cache": rb.query_cache_stats(),
+        "context_packing": rb.context_packing_stats(),
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+class _ProtoSlot:
+    """Stands in for ``st.empty()``: serializes each paint as Streamlit would send it."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def markdown(self, body: str, unsafe_allow_html: bool = False) -> None:
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = ForwardMsg()
+        msg.delta.new_element.markdown.body = body
+        msg.delta.new_element.markdown.allow_html = unsafe_allow_html
+        self.messages += 1
+        self.bytes += len(msg.SerializeToString())
+
+
+def bench_render(args) -> dict:
+    """
+    Websocket messages / bytes / CPU for one streamed answer (per-token
+    repaint vs. ui_render.StreamRenderer), and history bytes per rerun
+    (two elements per turn vs. one cached element).
+    """
+    import ui_render
+    from streamlit import config
+
+    rng = random.Random(7)
+    tokens = [" " + rng.choice(_WORDS) for _ in range(args.tokens)]
+
+    def per_token(slot):
+        text = ""
+        for token in tokens:
+            text += token
+            slot.markdown(ui_render.ai_bubble(text, cursor=True), unsafe_allow_html=True)
+        slot.markdown(ui_render.ai_bubble(text), unsafe_allow_html=True)
+
+    def throttled(slot):
+        now = [0.0]  # simulated clock: one token every --token-ms
+        renderer = ui_render.StreamRenderer(slot, clock=lambda: now[0])
+        for token in tokens:
+            now[0] += args.token_ms / 1000
+            renderer.push(token)
+        renderer.close()
+
+    stream = {}
+    for name, run in (("per_token", per_token), ("throttled", throttled)):
+        slot = _ProtoSlot()
+        started = time.process_time()
+        run(slot)
+        stream[name] = {
+            "messages": slot.messages,
+            "kbytes": round(slot.bytes / 1024, 1),
+            "cpu_ms": round((time.process_time() - started) * 1000, 2),
+        }
+
+    # Messages at least this large are sent once, then referenced by hash
+    cache_min = config.get_option("global.minCachedMessageSize")
+    answer = " ".join(t.strip() for t in tokens)
+    history = {}
+    for n in args.turns:
+        turns = [(f"Question {i} about the {rng.choice(_WORDS)}?", answer, False) for i in range(n)]
+        old = _ProtoSlot()
+        for q, a, is_err in turns:
+            old.markdown(ui_render.user_bubble(q), unsafe_allow_html=True)
+            old.markdown(ui_render.ai_bubble(a, error=is_err), unsafe_allow_html=True)
+        new = _ProtoSlot()
+        new.markdown(ui_render.history_html(turns), unsafe_allow_html=True)
+        cached = new.bytes >= cache_min
+        history[n] = {
+            "per_turn_elements": {"messages": old.messages, "kbytes": round(old.bytes / 1024, 1)},
+            "single_element": {
+                "messages": 1,
+                "kbytes_first": round(new.bytes / 1024, 1),
+                # A hash reference is a few dozen bytes
+                "kbytes_repeat": 0.1 if cached else round(new.bytes / 1024, 1),
+            },
+        }
+    return {
+        "tokens": args.tokens,
+        "token_ms": args.token_ms,
+        "frame_ms": ui_render.STREAM_FRAME_MS,
+        "stream": stream,
+        "history_per_rerun": history,
+    }
+
+
+def bench_checkpoints(args) -> dict:
+    """
+    N sessions streaming chat turns at once, each on its own thread, against
+    the stock single-connection SqliteSaver and PooledSqliteSaver. Reports
+    checkpoint write (put / put_writes) and history read (get_tuple)
+    latency percentiles, plus turns/sec. Runs on local stand-ins.
+    """
+    import sqlite3
+    import tempfile
+    import threading
+
+    workdir = tempfile.mkdtemp(prefix="querymypdf-ckpt-")
+    os.environ["INDEX_DIR"] = os.path.join(workdir, "indexes")
+    os.environ["EMBED_CACHE_PATH"] = os.path.join(workdir, "embeddings_cache.db")
+    os.chdir(workdir)
+
+    from langchain_core.messages import HumanMessage
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    import RAG_backend as rb
+    from bench_fakes import FakeChatModel, FakeEmbeddings
+    from sqlite_saver import PooledSqliteSaver
+
+    rb.embeddings = FakeEmbeddings()
+    rb.llm = FakeChatModel(ttft=args.llm_ttft, token_latency=args.llm_token_latency)
+    rb.llm_with_tools = rb.llm.bind_tools(rb.tools)
+    pdf = synthetic_pdf(10)
+
+    def _timed(samples: List[float], fn):
+        def wrapper(*a, **kw):
+            started = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                samples.append((time.perf_counter() - started) * 1000)
+        return wrapper
+
+    savers = {
+        "shared": lambda path: SqliteSaver(sqlite3.connect(path, check_same_thread=False)),
+        "pooled": lambda path: PooledSqliteSaver(path, readers=args.readers),
+    }
+    report: dict = {"cpus": os.cpu_count(), "turns_per_session": args.turns, "results": {}}
+    for name in args.savers:
+        report["results"][name] = {}
+        for sessions in args.sessions:
+            saver = savers[name](os.path.join(workdir, f"{name}-{sessions}.db"))
+            samples: Dict[str, List[float]] = {"put": [], "put_writes": [], "get_tuple": []}
+            for method in samples:
+                setattr(saver, method, _timed(samples[method], getattr(saver, method)))
+            graph = rb._build_graph(args.mode, saver)
+            thread_ids = [f"{name}-{sessions}-{i}" for i in range(sessions)]
+            for thread_id in thread_ids:
+                rb.ingest_pdf(pdf, thread_id, "bench.pdf")  # shared index after the first
+            errors: List[str] = []
+
+            def _session(thread_id: str) -> None:
+                config = {"configurable": {"thread_id": thread_id}}
+                try:
+                    for turn in range(args.turns):
+                        question = _DEFAULT_QUESTIONS[turn % len(_DEFAULT_QUESTIONS)]
+                        for _ in graph.stream(
+                            {"messages": [HumanMessage(content=question)]},
+                            config=config,
+                            stream_mode="messages",
+                        ):
+                            pass
+                except Exception as e:  # surfaced in the report instead of killing the run
+                    errors.append(f"{type(e).__name__}: {e}")
+
+            workers = [threading.Thread(target=_session, args=(t,)) for t in thread_ids]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+            report["results"][name][sessions] = {
+                "turns_per_sec": round(sessions * args.turns / elapsed, 2),
+                **{f"{method}_ms": _percentiles(values) for method, values in samples.items()},
+                "errors": errors[:5],
+            }
+    return report
+
+
+def bench_embeddings(args) -> dict:
+    """Chunks/sec of each embedding backend, bypassing the embedding cache."""
+    import RAG_backend as rb
+
+    texts = synthetic_chunks(args.chunks)
+    results = {}
+    for spec in args.backends:
+        name, *opts = spec.split(":")
+        try:
+            if name == "local":
+                runtime = "onnx" if "onnx" in opts else "torch"
+                client = rb._local_embeddings(
+                    runtime=runtime, quantize="int8" in opts, threads=args.threads
+                )
+                client.embed_documents(texts[:8])  # warm-up
+                embed = client.embed_documents
+            else:
+                client = rb._build_embeddings(name)
+                embed = rb._EmbeddingScheduler(client.embed_documents).embed
+        except Exception as e:
+            results[spec] = {"error": f"{type(e).__name__}: {e}"}
+            continue
+        started = time.perf_counter()
+        vectors = embed(texts)
+        elapsed = time.perf_counter() - started
+        results[spec] = {
+            "chunks": len(texts),
+            "dim": len(vectors[0]) if vectors else 0,
+            "seconds": round(elapsed, 3),
+            "chunks_per_sec": round(len(texts) / elapsed, 1) if elapsed else None,
+        }
+    return results
+
+
+def bench_memory(args) -> dict:
+    """
+    RAM held per document for chunk texts and metadata (tracemalloc), for the
+    LangChain layout (FAISS docstore of ``Document`` objects plus a metadata
+    dict per chunk) vs. the compact chunk store: while ingesting, and once
+    the document is indexed. The FAISS vectors are the same in both and
+    listed separately.
+    """
+    import gc
+    import tracemalloc
+
+    import faiss
+    import numpy as np
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.documents import Document
+
+    import RAG_backend as rb
+    from bench_fakes import FakeEmbeddings
+
+    def traced(build):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            kept = build()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return kept, current, peak
+
+    splitter = rb._make_splitter()
+    results = {}
+    for n in args.chunks:
+        # Pages of roughly chunks_per_page chunks each, as _iter_pdf_pages yields them
+        pieces = synthetic_chunks(n, seed=n)
+        pages = [
+            Document(
+                page_content="\n\n".join(pieces[i : i + args.chunks_per_page]),
+                metadata={"source": "bench.pdf", "page": p, "page_label": str(p + 1), "total_pages": 0},
+            )
+            for p, i in enumerate(range(0, n, args.chunks_per_page))
+        ]
+        for page in pages:
+            page.metadata["total_pages"] = len(pages)
+        n_chunks = sum(len(splitter.split_text(page.page_content)) for page in pages)
+        vectors = synthetic_vectors(n_chunks, dim=args.dim, seed=n)
+        group = rb.INGEST_EMBED_GROUP
+
+        def langchain_ingest():
+            texts, metadatas, store = [], [], None
+            for page in pages:
+                for chunk in splitter.split_documents([page]):
+                    chunk.metadata["doc_id"] = "bench"
+                    chunk.metadata["chunk_id"] = len(texts)
+                    texts.append(chunk.page_content)
+                    metadatas.append(chunk.metadata)
+            for start in range(0, len(texts), group):
+                pairs = list(zip(texts[start : start + group], vectors[start : start + group]))
+                metas = metadatas[start : start + group]
+                if store is None:
+                    store = FAISS.from_embeddings(pairs, FakeEmbeddings(), metadatas=metas)
+                else:
+                    store.add_embeddings(pairs, metadatas=metas)
+            rb._ChunkStore.from_chunks(texts, metadatas)  # built at publish, then dropped
+            return store
+
+        def compact_ingest():
+            chunks, pending, index = rb._ChunkStoreBuilder("bench.pdf", "bench"), [], None
+            for page in pages:
+                chunks.add_page(page.metadata["page"], page.metadata["page_label"], len(pages))
+                for text in splitter.split_text(page.page_content):
+                    chunks.add(text, page.metadata["page"])
+                    pending.append(text)
+                if len(pending) >= group or page is pages[-1]:
+                    rows = vectors[len(chunks) - len(pending) : len(chunks)]
+                    if index is None:
+                        index = faiss.IndexFlatL2(args.dim)
+                    index.add(np.ascontiguousarray(rows))
+                    pending = []
+            return index, chunks.build()
+
+        # What is still allocated when the build returns is what a loaded document keeps
+        store, old_resident, old_peak = traced(langchain_ingest)
+        (index, new_chunks), new_resident, new_peak = traced(compact_ingest)
+        assert [store.docstore.search(i).page_content for i in store.index_to_docstore_id.values()] == list(new_chunks)
+        del store
+        results[str(n)] = {
+            "chunks": n_chunks,
+            "text_mb": round(new_chunks.buffer.nbytes / 2**20, 2),
+            "faiss_vectors_mb": round(rb.faiss_index_bytes(index) / 2**20, 2),
+            "ingest_peak_mb": {
+                "langchain": round(old_peak / 2**20, 2),
+                "compact": round(new_peak / 2**20, 2),
+            },
+            "resident_mb": {
+                "langchain_docstore": round(old_resident / 2**20, 2),
+                "compact": round(new_resident / 2**20, 2),
+            },
+        }
+    return results
+
+
+def _import_profile(stderr: str, top: int) -> dict:
+    """Parse ``python -X importtime`` output: RAG_backend's total and its slowest direct imports."""
+    total, children = 0, []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header row
+        depth = (len(name) - len(name.lstrip()) - 1) // 2  # two spaces per nesting level
+        name = name.strip()
+        if depth == 1:
+            children.append((name, int(cumulative)))
+        elif depth == 0 and name != "RAG_backend":
+            children = []  # a sibling's imports (they are listed before their parent)
+        elif depth == 0:
+            total = int(cumulative)
+            children.append(("(module body)", int(self_us)))
+            break  # later lines are what prewarm() imports
+    children.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "import_seconds": round(total / 1e6, 3),
+        "slowest_ms": {name: round(us / 1000, 1) for name, us in children[:top]},
+    }
+
+
+def bench_coldstart(args) -> dict:
+    """
+    Cold start per STARTUP_MODE: an ``-X importtime`` profile of
+    ``import RAG_backend`` (plus what ``prewarm()`` still has to build), and
+    time-to-first-paint of a fresh ``streamlit run APP.py``, from process
+    spawn to the first element and to the end of the first script run, as
+    a browser connecting over the websocket sees it.
+    """
+    import asyncio
+    import subprocess
+    import sys
+    import tempfile
+    import urllib.request
+
+    import websockets
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = (
+        "import sys, time; sys.path.insert(0, %r)\n"
+        "import RAG_backend as rb\n"
+        "started = time.perf_counter(); rb.prewarm()\n"
+        "print(time.perf_counter() - started)" % here
+    )
+
+    async def first_page(port: int, spawned: float) -> dict:
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1).read()
+                break
+            except OSError:
+                await asyncio.sleep(0.02)
+        ready = time.perf_counter() - spawned
+        url = f"ws://127.0.0.1:{port}/_stcore/stream"
+        async with websockets.connect(url, subprotocols=["streamlit"], max_size=None) as ws:
+            rerun = BackMsg()
+            rerun.rerun_script.query_string = ""
+            await ws.send(rerun.SerializeToString())
+            first = None
+            while True:
+                msg = ForwardMsg()
+                msg.ParseFromString(await ws.recv())
+                kind = msg.WhichOneof("type")
+                if kind == "delta" and first is None:
+                    first = time.perf_counter() - spawned
+                if kind == "script_finished":
+                    break
+        return {
+            "server_ready_s": ready,
+            "first_paint_s": first,
+            "page_complete_s": time.perf_counter() - spawned,
+        }
+
+    results = {}
+    for mode in args.modes:
+        env = dict(os.environ, STARTUP_MODE=mode)
+        runs: Dict[str, List[float]] = {}
+        profile: dict = {}
+        for _ in range(args.repeat):
+            # Fresh scratch directory each time: no index store, chatbot.db or caches to reuse
+            workdir = tempfile.mkdtemp(prefix="querymypdf-coldstart-")
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", probe],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True,
+            )
+            profile = _import_profile(proc.stderr, args.top)
+            runs.setdefault("import_s", []).append(profile["import_seconds"])
+            runs.setdefault("prewarm_s", []).append(float(proc.stdout.strip().splitlines()[-1]))
+
+            workdir = tempfile.mkdtemp(prefix="querymypdf-coldstart-")
+            spawned = time.perf_counter()
+            server = subprocess.Popen(
+                [
+                    sys.executable, "-m", "streamlit", "run", os.path.join(here, "APP.py"),
+                    "--server.headless", "true", "--server.port", str(args.port),
+                    "--browser.gatherUsageStats", "false",
+                ],
+                cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                page = asyncio.run(asyncio.wait_for(first_page(args.port, spawned), args.timeout))
+            finally:
+                server.terminate()
+                server.wait()
+            for key, value in page.items():
+                runs.setdefault(key, []).append(value)
+        results[mode] = {
+            **{key: round(statistics.median(values), 3) for key, values in runs.items()},
+            "import_profile_ms": profile["slowest_ms"],
+        }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="QueryMyPDF benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("embeddings", help="compare embedding backends (chunks/sec)")
+    p.add_argument("--chunks", type=int, default=256)
+    p.add_argument("--threads", type=int, default=0, help="intra-op threads for local runs")
+    p.add_argument(
+        "--backends", nargs="+", default=["remote", "local"],
+        help="remote | local[:onnx][:int8]",
+    )
+    p.set_defaults(func=bench_embeddings)
+
+    p = sub.add_parser("extract", help="PDF text extraction pages/sec vs. worker count")
+    p.add_argument("--pages", type=int, default=500)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("bm25", help="rank_bm25 vs. NumPy BM25 index")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--chunk-chars", type=int, default=800)
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--k", type=int, default=6)
+    p.set_defaults(func=bench_bm25)
+
+    p = sub.add_parser("faiss", help="recall@k vs. memory and latency per FAISS index type")
+    p.add_argument("--sizes", type=int, nargs="+", default=[5000, 50000])
+    p.add_argument("--types", nargs="+", default=["flat", "hnsw", "sq8", "fp16", "ivfsq8", "ivfpq"])
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=6)
+    p.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    p.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128])
+    p.set_defaults(func=bench_faiss)
+
+    p = sub.add_parser("graph", help="TTFT and tokens billed: agent vs. pre-retrieval graph")
+    p.add_argument("--modes", nargs="+", default=["agent", "preretrieval"])
+    p.add_argument("--pages", type=int, default=40)
+    p.add_argument("--questions", nargs="*")
+    p.add_argument("--offline", action="store_true", help="local stand-ins instead of Gemini/HF")
+    p.add_argument("--llm-ttft", type=float, default=0.3, help="stand-in LLM (--offline)")
+    p.add_argument("--llm-token-latency", type=float, default=0.01, help="stand-in LLM (--offline)")
+    p.set_defaults(func=bench_graph)
+
+    p = sub.add_parser("offline", help="every ingest/query stage against local stand-ins (no keys)")
+    p.add_argument("--pages", type=int, default=50)
+    p.add_argument("--queries", type=int, default=30)
+    p.add_argument("--modes", nargs="+", default=["agent", "preretrieval"])
+    p.add_argument("--questions", nargs="*")
+    p.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding call")
+    p.add_argument("--embed-per-text", type=float, default=0.001, help="extra seconds per text")
+    p.add_argument("--embed-throttle", type=float, default=0.05, help="fraction of calls that 429")
+    p.add_argument("--llm-ttft", type=float, default=0.3)
+    p.add_argument("--llm-token-latency", type=float, default=0.01)
+    p.add_argument("--llm-throttle", type=float, default=0.0)
+    p.add_argument("--out", help="also write the JSON report here (e.g. per commit)")
+    p.set_defaults(func=bench_offline)
+
+    p = sub.add_parser("render", help="streamed-answer repaint cost and history bytes per rerun")
+    p.add_argument("--tokens", type=int, default=400)
+    p.add_argument("--token-ms", type=float, default=10.0, help="simulated gap between tokens")
+    p.add_argument("--turns", type=int, nargs="+", default=[5, 20, 50])
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("checkpoints", help="checkpoint latency under concurrent sessions")
+    p.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 16])
+    p.add_argument("--turns", type=int, default=10, help="turns per session")
+    p.add_argument("--savers", nargs="+", default=["shared", "pooled"])
+    p.add_argument("--readers", type=int, default=4)
+    p.add_argument("--mode", default="agent")
+    p.add_argument("--llm-ttft", type=float, default=0.05)
+    p.add_argument("--llm-token-latency", type=float, default=0.002)
+    p.set_defaults(func=bench_checkpoints)
+
+    p = sub.add_parser("memory", help="per-document RAM: LangChain docstore vs. compact chunk store")
+    p.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000])
+    p.add_argument("--chunks-per-page", type=int, default=4)
+    p.add_argument("--dim", type=int, default=384)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("coldstart", help="import profile and time-to-first-paint per STARTUP_MODE")
+    p.add_argument("--modes", nargs="+", default=["eager", "lazy"])
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--top", type=int, default=12, help="slowest imports to list")
+    p.add_argument("--port", type=int, default=8599)
+    p.add_argument("--timeout", type=float, default=120.0)
+    p.set_defaults(func=bench_coldstart)
+
+    args = parser.parse_args()
+    print(json.dumps(args.func(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
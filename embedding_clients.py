@@ -0,0 +1,123 @@
+"""
+Embedding clients built by ``RAG_backend._build_embeddings``.
+
+Kept out of RAG_backend so that importing it does not pull in
+langchain_core; this module is only loaded when the first embedding
+client is constructed.
+"""
+from __future__ import annotations
+
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+
+class HTTPEndpointEmbeddings(Embeddings):
+    """Minimal client for an HF-compatible ``{"inputs": [...]}`` feature-extraction URL."""
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = 60.0):
+        self.url = url
+        self.timeout = timeout
+        import requests
+
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        resp = self.session.post(self.url, json={"inputs": texts}, timeout=self.timeout)
+        resp.raise_for_status()  # HTTPError carries .response for the rate limiter
+        return resp.json()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    In-process CPU inference of the embedding model via sentence-transformers.
+
+    Texts are sorted by length and packed into batches of at most
+    ``batch_tokens`` padded tokens, so short chunks aren't padded to the
+    longest one in the document. Supports the torch and ONNX Runtime
+    backends, a fixed intra-op thread count and optional int8 weights.
+    """
+
+    is_local = True
+
+    def __init__(
+        self,
+        model_name: str,
+        runtime: str = "torch",
+        quantize: bool = False,
+        threads: int = 0,
+        batch_tokens: int = 8192,
+        onnx_int8_file: str = "onnx/model_qint8_avx2.onnx",
+    ):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "EMBEDDING_BACKEND=local requires `pip install sentence-transformers` "
+                "(and `onnxruntime` for EMBEDDING_RUNTIME=onnx)."
+            ) from e
+
+        if runtime == "onnx":
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            model_kwargs: dict = {"provider": "CPUExecutionProvider", "session_options": options}
+            if quantize:
+                model_kwargs["file_name"] = onnx_int8_file
+            self.model = SentenceTransformer(
+                model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs
+            )
+        elif runtime == "torch":
+            import torch
+
+            if threads:
+                torch.set_num_threads(threads)
+            self.model = SentenceTransformer(model_name, device="cpu")
+            if quantize:
+                self.model = torch.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+        else:
+            raise ValueError(f"Unknown EMBEDDING_RUNTIME: {runtime!r}")
+        self.max_tokens = int(self.model.max_seq_length or 256)
+        self.batch_tokens = max(batch_tokens, self.max_tokens)
+
+    def _batches(self, texts: List[str]) -> List[List[int]]:
+        # ~4 characters per token is close enough to bucket by length
+        lengths = [min(self.max_tokens, len(t) // 4 + 2) for t in texts]
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        batches: List[List[int]] = []
+        current: List[int] = []
+        for i in order:
+            # Sorted ascending, so the newest item is always the longest in the batch
+            if current and (len(current) + 1) * lengths[i] > self.batch_tokens:
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        return batches
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        for idx in self._batches(texts):
+            vectors = self.model.encode(
+                [texts[i] for i in idx],
+                batch_size=len(idx),
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            for i, vec in zip(idx, vectors):
+                out[i] = vec.tolist()
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,183 @@
+"""
+Latency spans aggregated into Prometheus-style histograms.
+
+    from metrics import span, observe
+
+    with span("retrieval.faiss"):
+        ...
+    observe("ui.ttft", seconds)
+
+Every stage shares one metric family, ``querymypdf_stage_seconds``, with a
+``stage`` label. Exposition:
+
+    METRICS_FILE=metrics.prom   # rewritten every METRICS_FILE_INTERVAL seconds
+    METRICS_PORT=9464           # GET /metrics on a background HTTP server
+"""
+from __future__ import annotations
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+FAMILY = "querymypdf_stage_seconds"
+# Upper bounds in seconds; spans range from sub-millisecond lookups to minute-long ingests
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+
+class Histogram:
+    """Cumulative-bucket histogram plus the last observed value."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.last = seconds
+
+    def quantile(self, q: float) -> float:
+        """Estimate by linear interpolation inside the bucket holding the q-th value."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+_histograms: Dict[str, Histogram] = {}
+_lock = threading.Lock()
+
+
+def observe(stage: str, seconds: float) -> None:
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time the block (also when it raises) into the ``stage`` histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def snapshot() -> List[dict]:
+    """Per-stage count / mean / p50 / p95 / last in milliseconds, sorted by stage."""
+    with _lock:
+        rows = []
+        for stage, h in sorted(_histograms.items()):
+            rows.append(
+                {
+                    "stage": stage,
+                    "count": h.count,
+                    "mean_ms": round(h.sum / h.count * 1000, 2) if h.count else 0.0,
+                    "p50_ms": round(h.quantile(0.5) * 1000, 2),
+                    "p95_ms": round(h.quantile(0.95) * 1000, 2),
+                    "last_ms": round(h.last * 1000, 2),
+                }
+            )
+        return rows
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = [
+        f"# HELP {FAMILY} Latency of QueryMyPDF pipeline stages.",
+        f"# TYPE {FAMILY} histogram",
+    ]
+    with _lock:
+        for stage, h in sorted(_histograms.items()):
+            label = stage.replace("\\", "\\\\").replace('"', '\\"')
+            cumulative = 0
+            for bound, n in zip((*h.buckets, "+Inf"), h.counts):
+                cumulative += n
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(f'{FAMILY}_bucket{{stage="{label}",le="{le}"}} {cumulative}')
+            lines.append(f'{FAMILY}_sum{{stage="{label}"}} {h.sum:.6f}')
+            lines.append(f'{FAMILY}_count{{stage="{label}"}} {h.count}')
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+
+
+# -- exporters ------------------------------------------------------------------
+def write_file(path: str) -> None:
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802 (http.server API)
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def start_exporters(path: Optional[str] = None, port: Optional[int] = None) -> None:
+    """Start the file writer / HTTP endpoint (default: from the environment) once per process."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    # Read at call time so values from .env (loaded after imports) apply
+    path = path or os.getenv("METRICS_FILE")
+    port = port or int(os.getenv("METRICS_PORT", "0"))
+    interval = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+    if path:
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    write_file(path)
+                except OSError:
+                    pass
+
+        threading.Thread(target=_loop, name="metrics-file", daemon=True).start()
+    if port:
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+        except OSError:
+            return  # port taken (e.g. a second server process); the file exporter still runs
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
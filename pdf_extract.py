@@ -0,0 +1,82 @@
+"""
+Page-parallel PDF text extraction.
+
+Kept in its own small module so process-pool workers only import pypdf,
+not the Streamlit / LangChain stack that RAG_backend pulls in.
+"""
+from __future__ import annotations
+
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from pypdf import PdfReader
+
+# Below this many pages the pool start-up costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_READER: Optional[PdfReader] = None
+
+
+def _init_worker(file_bytes: bytes) -> None:
+    # Parse the file once per worker instead of once per shard
+    global _READER
+    _READER = PdfReader(io.BytesIO(file_bytes))
+
+
+def _extract_range(bounds: Tuple[int, int]) -> List[str]:
+    start, end = bounds
+    return [_READER.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _shards(total: int, workers: int) -> List[Tuple[int, int]]:
+    # Several small shards per worker keeps the pool balanced and lets the
+    # caller start consuming early pages while later ones are still running
+    size = max(1, -(-total // (workers * 4)))
+    return [(s, min(total, s + size)) for s in range(0, total, size)]
+
+
+def iter_page_texts(
+    file_bytes: bytes,
+    reader: Optional[PdfReader] = None,
+    workers: Optional[int] = None,
+    min_pages: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    Yield the extracted text of every page, in page order.
+
+    Large documents are sharded into page ranges across a process pool;
+    documents under ``min_pages`` (or ``workers <= 1``) are read in-process.
+    """
+    reader = reader or PdfReader(io.BytesIO(file_bytes))
+    total = len(reader.pages)
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
+    min_pages = PDF_PARALLEL_MIN_PAGES if min_pages is None else min_pages
+
+    if workers <= 1 or total < max(min_pages, 2):
+        for page in reader.pages:
+            yield page.extract_text() or ""
+        return
+
+    shards = _shards(total, workers)
+    # spawn: forking a multi-threaded Streamlit server is not safe
+    ctx = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(
+        max_workers=min(workers, len(shards)),
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(file_bytes,),
+    )
+    try:
+        # map() yields shard results in submission (= page) order
+        for texts in pool.map(_extract_range, shards):
+            yield from texts
+    except BaseException:
+        # GeneratorExit when the caller stopped early (e.g. a cancelled ingest),
+        # or a failed shard: drop the queued shards instead of waiting for them
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
@@ -0,0 +1,137 @@
+"""
+SQLite checkpointers tuned for many concurrent chat sessions.
+
+    from sqlite_saver import PooledSqliteSaver
+    checkpointer = PooledSqliteSaver("chatbot.db", readers=4)
+
+The stock ``SqliteSaver`` funnels every read and write through one shared
+connection and one lock, so a session loading its history waits behind
+other sessions' checkpoint writes. ``PooledSqliteSaver`` keeps a single
+writer connection (SQLite allows one writer at a time anyway) and hands
+reads (``get_tuple`` / ``list``) to a small pool of read-only
+connections; in WAL mode those never block on, or are blocked by, the
+writer. Commits use ``synchronous=NORMAL``: still crash-safe in WAL mode,
+without an fsync per checkpoint.
+
+For asyncio servers, ``open_async_checkpointer`` yields LangGraph's
+``AsyncSqliteSaver`` (or a subclass of it) over the same pragmas (needs
+``aiosqlite``).
+"""
+from __future__ import annotations
+
+import queue
+import sqlite3
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Optional, Type
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+if TYPE_CHECKING:
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+BUSY_TIMEOUT_MS = 5000
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+)
+
+
+def connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000)
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+class PooledSqliteSaver(SqliteSaver):
+    """``SqliteSaver`` with one locked writer connection and a pool of readers."""
+
+    def __init__(self, path: str, readers: int = 4, *, serde=None):
+        self._local = threading.local()
+        super().__init__(connect(path), serde=serde)
+        self.path = path
+        self.max_readers = max(1, readers)
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._opened = 0
+        self._open_lock = threading.Lock()
+        with self.lock:
+            self.setup()  # create tables on the writer before any reader opens
+
+    # SqliteSaver reads ``self.conn`` directly in a few places (e.g. the
+    # pending-writes cursor in ``list``); inside a read it resolves to the
+    # reader borrowed by this thread, otherwise to the writer.
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return getattr(self._local, "conn", None) or self._writer
+
+    @conn.setter
+    def conn(self, value: sqlite3.Connection) -> None:
+        self._writer = value
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._open_lock:
+            if self._opened < self.max_readers:
+                self._opened += 1
+                return connect(self.path, read_only=True)
+        return self._readers.get()  # all readers busy: wait for one
+
+    @contextmanager
+    def cursor(self, transaction: bool = True) -> Iterator[sqlite3.Cursor]:
+        if transaction:
+            with self.lock:
+                cur = self._writer.cursor()
+                try:
+                    yield cur
+                finally:
+                    self._writer.commit()
+                    cur.close()
+            return
+        reader = self._acquire_reader()
+        previous = getattr(self._local, "conn", None)
+        self._local.conn = reader
+        cur = reader.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            self._local.conn = previous
+            self._readers.put(reader)
+
+    def stats(self) -> dict:
+        return {"readers_open": self._opened, "readers_idle": self._readers.qsize()}
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        self._writer.close()
+
+
+@asynccontextmanager
+async def open_async_checkpointer(
+    path: str, saver_cls: Optional[Type[AsyncSqliteSaver]] = None
+) -> AsyncIterator[AsyncSqliteSaver]:
+    """
+    ``AsyncSqliteSaver`` (or ``saver_cls``) on a WAL-mode connection, for
+    ``chatbot.astream`` under asyncio servers. aiosqlite runs the connection
+    on its own thread, which acts as the single writer.
+    """
+    import aiosqlite  # optional: pip install aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    async with aiosqlite.connect(path, timeout=BUSY_TIMEOUT_MS / 1000) as conn:
+        for pragma in _PRAGMAS:
+            await conn.execute(pragma)
+        saver = (saver_cls or AsyncSqliteSaver)(conn)
+        await saver.setup()
+        yield saver
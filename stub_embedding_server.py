@@ -0,0 +1,113 @@
+"""
+Local stand-in for the HF Inference feature-extraction endpoint.
+
+Returns deterministic unit vectors for every input text and injects
+rate limiting so the embedding scheduler can be exercised offline:
+
+    python stub_embedding_server.py --port 8765 --rate 5 --p503 0.05
+    EMBEDDING_ENDPOINT=http://127.0.0.1:8765 streamlit run APP.py
+
+Requests above ``--rate`` per second get a 429 with a Retry-After header.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+
+def fake_vector(text: str, dim: int = 384) -> List[float]:
+    """Deterministic unit vector derived from the text hash."""
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vec / np.linalg.norm(vec)).tolist()
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """Consume a token; return 0 on success or the seconds until one is free."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+def make_server(
+    port: int = 8765,
+    rate: float = 5.0,
+    burst: float = 5.0,
+    p503: float = 0.0,
+    latency: float = 0.05,
+    dim: int = 384,
+) -> ThreadingHTTPServer:
+    bucket = _Bucket(rate, burst)
+    counters = {"requests": 0, "throttled": 0, "unavailable": 0, "texts": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):  # keep benchmark output clean
+            pass
+
+        def _reply(self, status: int, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._reply(200, counters)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            counters["requests"] += 1
+            wait = bucket.take()
+            if wait > 0:
+                counters["throttled"] += 1
+                return self._reply(429, {"error": "rate limited"}, {"Retry-After": f"{wait:.2f}"})
+            if random.random() < p503:
+                counters["unavailable"] += 1
+                return self._reply(503, {"error": "model loading"}, {"Retry-After": "1"})
+            inputs = payload.get("inputs", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            time.sleep(latency)
+            counters["texts"] += len(inputs)
+            self._reply(200, [fake_vector(t, dim) for t in inputs])
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.counters = counters
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=5.0, help="allowed requests/sec")
+    parser.add_argument("--burst", type=float, default=5.0)
+    parser.add_argument("--p503", type=float, default=0.0, help="probability of a 503")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    args = parser.parse_args()
+    srv = make_server(args.port, args.rate, args.burst, args.p503, args.latency)
+    print(f"Stub embedding server on http://127.0.0.1:{args.port}")
+    srv.serve_forever()
@@ -0,0 +1,91 @@
+"""
+Chat bubble HTML and a throttled renderer for streamed answers.
+
+Kept free of Streamlit imports so ``benchmark.py render`` can measure it;
+``slot`` is anything with a ``markdown(body, unsafe_allow_html=...)`` method
+(an ``st.empty()`` placeholder in the app).
+"""
+from __future__ import annotations
+
+import os
+import time
+from typing import Iterable, Tuple
+
+# Repaint the streaming bubble at most every STREAM_FRAME_MS, or sooner once
+# STREAM_FLUSH_CHARS new characters are waiting
+STREAM_FRAME_MS = float(os.getenv("STREAM_FRAME_MS", "80"))
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "400"))
+
+_AI_LABEL = '<div class="lbl lbl-ai"><span class="ai-dot"></span>Assistant</div>'
+_CURSOR = "&#9646;"
+
+
+def user_bubble(text: str) -> str:
+    return f'<div class="bubble-user-wrap"><div class="bubble-user"><div class="lbl">You</div>{text}</div></div>'
+
+
+def ai_bubble(text: str, cursor: bool = False, error: bool = False) -> str:
+    if error:
+        return f'<div class="bubble-ai-wrap"><div class="bubble-err">{text}</div></div>'
+    return (
+        f'<div class="bubble-ai-wrap"><div class="bubble-ai">{_AI_LABEL}'
+        f'{text}{_CURSOR if cursor else ""}</div></div>'
+    )
+
+
+def history_html(turns: Iterable[Tuple[str, str, bool]]) -> str:
+    """All committed turns as one HTML block: (question, answer, is_error) each."""
+    return "".join(user_bubble(q) + ai_bubble(a, error=is_err) for q, a, is_err in turns)
+
+
+class StreamRenderer:
+    """
+    Buffers streamed tokens and repaints the slot on a frame budget.
+
+    The first token is shown immediately. After that the bubble is
+    repainted at most once per frame, or early when enough text is
+    waiting. Each repaint costs one websocket message, so the number of
+    messages is bounded by elapsed time rather than by the token count.
+    """
+
+    def __init__(
+        self,
+        slot,
+        frame_seconds: float = STREAM_FRAME_MS / 1000,
+        flush_chars: int = STREAM_FLUSH_CHARS,
+        clock=time.monotonic,
+    ):
+        self.slot = slot
+        self.frame_seconds = frame_seconds
+        self.flush_chars = flush_chars
+        self.clock = clock
+        self.text = ""
+        self.pending = 0
+        self.last_flush = None
+        self.frames = 0
+        self.bytes_sent = 0
+
+    def push(self, token: str) -> None:
+        if not token:
+            return
+        self.text += token
+        self.pending += len(token)
+        now = self.clock()
+        if (
+            self.last_flush is None
+            or now - self.last_flush >= self.frame_seconds
+            or self.pending >= self.flush_chars
+        ):
+            self._paint(cursor=True)
+            self.last_flush = now
+
+    def close(self) -> None:
+        """Final repaint without the cursor (always sent, so the last tokens show)."""
+        self._paint(cursor=False)
+
+    def _paint(self, cursor: bool) -> None:
+        body = ai_bubble(self.text, cursor=cursor)
+        self.slot.markdown(body, unsafe_allow_html=True)
+        self.pending = 0
+        self.frames += 1
+        self.bytes_sent += len(body.encode("utf-8"))